@@ -0,0 +1,68 @@
+import logging
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import database
+import websearch
+from catalog import catalog
+
+BACKFILL_BATCH = 5
+BACKFILL_RECHECK_AFTER = 7 * 24 * 60 * 60
+QUIET_HOURS = (2, 7)
+
+STORE_COLUMNS = {'steam': 'steam_link', 'gog': 'gog_link', 'epic': 'epic_link'}
+
+# Резолвер получает название игры и список магазинов, в которых нужно искать,
+# и возвращает найденные ссылки по магазинам.
+Resolver = Callable[[str, List[str]], Awaitable[Dict[str, List[str]]]]
+
+_request_counts: Counter = Counter()
+
+
+def record_game_request(game_id: int) -> None:
+    """Учитывает обращение к игре; счетчики пишутся в базу пачкой в flush_request_counts."""
+    _request_counts[game_id] += 1
+
+
+async def flush_request_counts() -> None:
+    if not _request_counts:
+        return
+    counts = dict(_request_counts)
+    _request_counts.clear()
+    await database.add_request_counts(counts)
+
+
+def is_quiet_hour(hour: Optional[int] = None) -> bool:
+    start, end = QUIET_HOURS
+    hour = time.localtime().tm_hour if hour is None else hour
+    return start <= hour < end
+
+
+def pick_link(store: str, links: List[str]) -> Optional[str]:
+    """Выбирает ссылку на страницу игры в магазине."""
+    for link in links:
+        if websearch.is_canonical_link(store, link):
+            return link
+    return None
+
+
+async def backfill_missing_links(resolve: Resolver, limit: int = BACKFILL_BATCH) -> int:
+    """Ищет недостающие ссылки для самых популярных игр и записывает найденные в базу.
+
+    Возвращает число игр, у которых появилась хотя бы одна новая ссылка.
+    """
+    games = await database.fetch_games_missing_links(limit, time.time() - BACKFILL_RECHECK_AFTER)
+    updated = 0
+    for game in games:
+        missing = [store for store, column in STORE_COLUMNS.items() if getattr(game, column) is None]
+        found = await resolve(game.name, missing)
+        links = {store: pick_link(store, found.get(store, [])) for store in missing}
+        new_game, version = await database.update_game_links(
+            game.id, links.get('steam'), links.get('gog'), links.get('epic'), time.time())
+        if new_game is not None:
+            catalog.apply(new_game, version)
+        if any(links.values()):
+            updated += 1
+            logging.info(f"Найдены недостающие ссылки для '{game.name}': {[s for s, l in links.items() if l]}")
+    return updated
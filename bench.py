@@ -0,0 +1,390 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+import callbacks
+import database
+import importer
+import mainpart
+import websearch
+from dp import migrate
+from matcher import normalize
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+DEFAULT_SIZES = '1k,100k,1m'
+ITERATIONS = 200
+MEMORY_ITERATIONS = 50
+BASELINE_PATH = 'bench_baseline.json'
+# Регрессией считается рост p50/p99 больше чем на эту долю и больше чем на NOISE_FLOOR_MS.
+REGRESSION_TOLERANCE = 0.25
+NOISE_FLOOR_MS = 0.5
+SEED = 42
+
+BOT_TOKEN = '123456:BENCHMARK'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+GENRES = ['Action', 'Adventure', 'RPG', 'Strategy', 'Simulation', 'Sports', 'Racing', 'Puzzle', 'Horror',
+          'Shooter', 'Platformer', 'Fighting', 'Stealth', 'Survival', 'Sandbox', 'MMO', 'Roguelike',
+          'Visual Novel', 'Rhythm', 'Card Game']
+SYLLABLES = ['ka', 'ri', 'vel', 'dun', 'ros', 'tor', 'mir', 'sha', 'lon', 'gar', 'eth', 'quin', 'zor', 'ba',
+             'nel', 'ur', 'fal', 'dra', 'kin', 'sol', 'wyn', 'tha', 'mor', 'ix']
+SUFFIXES = ['', '', '', ' II', ' III', ': Remastered', ' Online', ': Origins', ' Chronicles']
+
+
+class FakeRequest(BaseRequest):
+    """Транспорт Bot API без сети: считает вызовы методов и отвечает так, как ответил бы Telegram."""
+
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            chat_id = int(params.get('chat_id', 0))
+            result = {
+                'message_id': params.get('message_id') or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    """Собирает обновления в том виде, в каком их присылает Telegram."""
+
+    def __init__(self, bot) -> None:
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+    def message(self, user_id: int, text: str) -> Update:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        update_id = next(self._update_ids)
+        query = {
+            'id': str(update_id),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': 'Доступные жанры:',
+            },
+        }
+        return Update.de_json({'update_id': update_id, 'callback_query': query}, self.bot)
+
+
+_SITE_STORES = {site: store for store, site in websearch.STORE_SITES.items()}
+
+
+def fake_search(query: str, num: int = 10, start: int = 0, stop: Optional[int] = None, pause: float = 0.0):
+    """Заглушка googlesearch.search: детерминированные ссылки на страницы игры в магазине из site:.
+
+    Как и в googlesearch, stop - число выдаваемых результатов начиная со start.
+    """
+    name, _, site = query.partition(' site:')
+    slug = '_'.join(normalize(name).split())
+    path = websearch.CANONICAL_PATHS.get(_SITE_STORES.get(site), '/')
+    for index in range(start, start + (stop if stop is not None else num)):
+        yield f"https://{site}{path}{index}/{slug}/"
+
+
+def generate_rows(size: int, rng: random.Random):
+    """Случайные, но воспроизводимые по SEED строки каталога с уникальными названиями."""
+    seen = set()
+    for index in range(size):
+        words = [''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+                 for _ in range(rng.randint(1, 3))]
+        name = ' '.join(words) + rng.choice(SUFFIXES)
+        if name in seen:
+            name = f"{name} {index}"
+        seen.add(name)
+        slug = '_'.join(normalize(name).split())
+        yield (
+            name,
+            'PC',
+            rng.choice(GENRES),
+            f"https://store.steampowered.com/app/{index}/{slug}/" if rng.random() < 0.7 else None,
+            f"https://www.gog.com/game/{slug}" if rng.random() < 0.4 else None,
+            f"https://store.epicgames.com/ru/p/{slug}" if rng.random() < 0.3 else None,
+        )
+
+
+def prepare_database(data_dir: str, size: int) -> str:
+    """Создает базу с синтетическим каталогом; уже созданная база переиспользуется."""
+    path = os.path.join(data_dir, f'bench-{size}.db')
+    if os.path.exists(path):
+        return path
+    started = time.perf_counter()
+    conn = sqlite3.connect(path + '.tmp', isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        migrate(conn)
+        importer.import_catalog(conn, generate_rows(size, random.Random(SEED)))
+        conn.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        conn.close()
+    os.replace(path + '.tmp', path)
+    print(f"  сгенерирован каталог {size} игр за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+    return path
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def reset_state() -> None:
+    mainpart.KEYBOARD_CACHE.clear()
+    mainpart.SEARCH_CACHE.clear()
+    mainpart.SEARCH_IN_FLIGHT.clear()
+
+
+async def load_catalog() -> dict:
+    """Загружает каталог и индекс так же, как при запуске бота, и замеряет время и память.
+
+    Загрузка идет под tracemalloc, поэтому ее время завышено; сравнивать его
+    стоит только с другими прогонами бенчмарка.
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    await mainpart.catalog.load()
+    await mainpart.matcher.rebuild(mainpart.catalog.names())
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': elapsed, 'retained_mb': current / 2 ** 20, 'peak_mb': peak / 2 ** 20}
+
+
+def build_scenarios(factory: UpdateFactory, rng: random.Random) -> Dict[str, Callable[[int], Update]]:
+    """Сценарии: обработчик -> функция, собирающая i-е обновление для него."""
+    catalog = mainpart.catalog
+    genres = catalog.genres()
+    genre_pages = max(1, (len(genres) + 3) // 4)
+    ids = [game.id for genre in genres[:3] for game in catalog.games_page(genre, 0, 50)[0]]
+    names = [catalog.get(game_id).name for game_id in ids]
+
+    def typo(name: str) -> str:
+        position = rng.randrange(len(name))
+        return name[:position] + name[position + 1:]
+
+    # Среднее число страниц в жанре: листаем в его пределах, чтобы почти все страницы были непустыми.
+    games_pages = max(1, len(catalog) // max(1, len(genres)) // 5)
+
+    def search(i: int) -> Update:
+        return factory.callback(i, callbacks.encode("store", "any", f"{names[i % len(names)]} {i}"))
+
+    return {
+        'start': lambda i: factory.message(i, '/start'),
+        'show_genres_page': lambda i: factory.callback(i, callbacks.encode("genres", rng.randrange(genre_pages))),
+        'show_games_by_genre': lambda i: factory.callback(
+            i, callbacks.encode("genre", rng.choice(genres), rng.randrange(games_pages))),
+        'show_game_links': lambda i: factory.callback(i, callbacks.encode("game", rng.randint(1, len(catalog)))),
+        'search_game': lambda i: factory.message(i, typo(rng.choice(names))),
+        'perform_search': search,
+        # Те же запросы, что в perform_search, поэтому все они попадают в кэш.
+        'perform_search_cached': search,
+    }
+
+
+async def run_scenario(application: Application, make_update: Callable[[int], Update], iterations: int) -> dict:
+    updates = [make_update(i) for i in range(iterations)]
+    latencies = []
+    started = time.perf_counter()
+    for update in updates:
+        call_started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return {
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'ops_per_sec': iterations / elapsed if elapsed else 0.0,
+    }
+
+
+async def measure_peak(application: Application, make_update: Callable[[int], Update], iterations: int) -> float:
+    """Пиковая память обработчика отдельным прогоном: tracemalloc сильно искажает задержки."""
+    updates = [make_update(i) for i in range(iterations)]
+    tracemalloc.start()
+    for update in updates:
+        await application.process_update(update)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+async def bench_size(size: int, data_dir: str, iterations: int) -> dict:
+    database.configure(prepare_database(data_dir, size), 2)
+    reset_state()
+    load = await load_catalog()
+
+    errors: List[BaseException] = []
+
+    async def on_error(update: object, context) -> None:
+        errors.append(context.error)
+
+    request = FakeRequest()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_request(FakeRequest())
+        .updater(None)
+        .job_queue(None)
+        .build()
+    )
+    mainpart.register_handlers(application)
+    application.add_error_handler(on_error)
+    await application.initialize()
+
+    factory = UpdateFactory(application.bot)
+    rng = random.Random(SEED)
+    handlers = {}
+    try:
+        for name, make_update in build_scenarios(factory, rng).items():
+            handlers[name] = await run_scenario(application, make_update, iterations)
+            # Пиковую память холодного поиска меряем на новых названиях, иначе они уже в кэше.
+            offset = iterations if name == 'perform_search' else 0
+            handlers[name]['peak_kb'] = await measure_peak(
+                application, lambda i: make_update(i + offset), min(iterations, MEMORY_ITERATIONS))
+    finally:
+        await application.shutdown()
+        database.close()
+    if errors:
+        raise RuntimeError(f"Обработчики упали {len(errors)} раз, первая ошибка: {errors[0]!r}")
+    return {'load': load, 'handlers': handlers, 'api_calls': dict(request.calls)}
+
+
+def print_report(results: dict) -> None:
+    for size, result in results['sizes'].items():
+        load = result['load']
+        print(f"\nКаталог {size} игр: загрузка {load['seconds']:.2f} с, "
+              f"память {load['retained_mb']:.1f} МБ (пик {load['peak_mb']:.1f} МБ)")
+        print(f"{'обработчик':<24}{'p50, мс':>10}{'p99, мс':>10}{'оп/с':>10}{'пик, КБ':>10}")
+        for name, stats in result['handlers'].items():
+            print(f"{name:<24}{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}"
+                  f"{stats['ops_per_sec']:>10.0f}{stats['peak_kb']:>10.0f}")
+    print(f"\nПиковый RSS процесса: {results['max_rss_mb']:.0f} МБ")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Возвращает описания регрессий по сравнению с базовым прогоном."""
+    regressions = []
+    for size, result in results['sizes'].items():
+        base_handlers = baseline.get('sizes', {}).get(size, {}).get('handlers', {})
+        for name, stats in result['handlers'].items():
+            base = base_handlers.get(name)
+            if base is None:
+                continue
+            for metric in ('p50_ms', 'p99_ms'):
+                if stats[metric] > base[metric] * (1 + tolerance) and stats[metric] - base[metric] > NOISE_FLOOR_MS:
+                    regressions.append(f"{size} {name} {metric}: {base[metric]:.3f} -> {stats[metric]:.3f}")
+    return regressions
+
+
+def parse_sizes(text: str) -> List[int]:
+    return [SIZES[item] if item in SIZES else int(item) for item in text.lower().split(',') if item]
+
+
+async def run(sizes: List[int], data_dir: str, iterations: int) -> dict:
+    websearch.set_backend(fake_search)
+    # Планировщик без ограничения темпа: меряется сам бот, а не паузы между запросами к поисковику.
+    websearch.scheduler = websearch.SearchScheduler(rate=1e9, burst=10 ** 9)
+    try:
+        results = {'iterations': iterations, 'sizes': {}}
+        for size in sizes:
+            print(f"Каталог {size} игр...", file=sys.stderr)
+            results['sizes'][str(size)] = await bench_size(size, data_dir, iterations)
+    finally:
+        websearch.set_backend()
+        websearch.close()
+    results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота на синтетическом каталоге.")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="размеры каталога через запятую: 1k,100k,1m или числа")
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'bot-bench'),
+                        help="где хранить сгенерированные базы между запусками")
+    parser.add_argument('--save-baseline', nargs='?', const=BASELINE_PATH, metavar='PATH')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH, metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = asyncio.run(run(parse_sizes(args.sizes), args.data_dir, args.iterations))
+    print_report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+        print(f"Базовый прогон сохранен в {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nРегрессии:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nРегрессий нет")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from telegram import InlineKeyboardMarkup, Update
+from telegram.ext import ContextTypes
+
+import database
+
+REGISTRY_SIZE = 50000
+TOKEN_BYTES = 6
+
+Payload = Tuple[str, tuple]
+Handler = Callable[..., Awaitable[None]]
+
+
+def _dump(payload: Payload) -> str:
+    action, args = payload
+    return json.dumps([action, list(args)])
+
+
+class CallbackRegistry:
+    """Серверное хранилище параметров inline-кнопок.
+
+    В callback_data попадает только действие и короткий токен ("g:@Ab3x_9Qz"),
+    а сами параметры (жанр, название игры) хранятся здесь, поэтому данные
+    кнопки не упираются в лимит Telegram в 64 байта и не ломаются на "_" в
+    названиях. Параметры из одних только чисел кодируются прямо в данных
+    кнопки ("gm:105"). Токен - короткий хэш параметров, поэтому одинаковые
+    параметры получают один и тот же токен во всех процессах бота.
+
+    В памяти держатся maxsize последних использованных токенов, в базе - столько
+    же; токен, вытесненный из памяти, ищется в базе при нажатии кнопки.
+    """
+
+    def __init__(self, maxsize: int = REGISTRY_SIZE) -> None:
+        self.maxsize = maxsize
+        self._payloads: OrderedDict = OrderedDict()
+        self._tokens: Dict[Payload, str] = {}
+        # Токены, созданные или использованные с прошлого сохранения.
+        self._unsaved: Dict[str, Payload] = {}
+
+    def _remember(self, token: str, payload: Payload) -> None:
+        self._payloads[token] = payload
+        self._tokens[payload] = token
+        while len(self._payloads) > self.maxsize:
+            _, evicted = self._payloads.popitem(last=False)
+            self._tokens.pop(evicted, None)
+
+    @staticmethod
+    def _token(payload: Payload) -> str:
+        digest = hashlib.blake2b(_dump(payload).encode('utf-8'), digest_size=TOKEN_BYTES).digest()
+        return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+    def encode(self, action: str, *args) -> str:
+        """Возвращает callback_data для действия с параметрами."""
+        if all(isinstance(arg, int) for arg in args):
+            return f"{action}:{','.join(map(str, args))}"
+        payload = (action, args)
+        token = self._tokens.get(payload)
+        if token is None:
+            token = self._token(payload)
+            self._remember(token, payload)
+        else:
+            self._payloads.move_to_end(token)
+        self._unsaved[token] = payload
+        return f"{action}:@{token}"
+
+    def decode(self, data: str) -> Optional[Payload]:
+        """Возвращает (действие, параметры) или None, если кнопка устарела или не наша."""
+        action, _, rest = data.partition(':')
+        if rest.startswith('@'):
+            payload = self._payloads.get(rest[1:])
+            if payload is None or payload[0] != action:
+                return None
+            self._payloads.move_to_end(rest[1:])
+            self._unsaved[rest[1:]] = payload
+            return payload
+        try:
+            return action, tuple(int(arg) for arg in rest.split(',') if arg)
+        except ValueError:
+            return None
+
+    def touch(self, data: str) -> bool:
+        """Отмечает повторную отправку кнопки; False, если ее токен уже вытеснен из памяти."""
+        rest = data.partition(':')[2]
+        if not rest.startswith('@'):
+            return True
+        payload = self._payloads.get(rest[1:])
+        if payload is None:
+            return False
+        self._payloads.move_to_end(rest[1:])
+        self._unsaved[rest[1:]] = payload
+        return True
+
+    async def resolve(self, data: str) -> Optional[Payload]:
+        """То же, что decode, но токен, которого нет в памяти, ищется в базе."""
+        payload = self.decode(data)
+        action, _, rest = data.partition(':')
+        if payload is not None or not rest.startswith('@'):
+            return payload
+        stored = await database.fetch_callback_payload(rest[1:])
+        if stored is None:
+            return None
+        stored_action, args = json.loads(stored)
+        if stored_action != action:
+            return None
+        payload = (stored_action, tuple(args))
+        self._remember(rest[1:], payload)
+        self._unsaved[rest[1:]] = payload
+        return payload
+
+    async def load(self) -> None:
+        """Загружает сохраненные токены, чтобы кнопки в старых сообщениях работали после перезапуска."""
+        rows = await database.fetch_callback_payloads(self.maxsize)
+        for token, payload in rows:
+            action, args = json.loads(payload)
+            self._remember(token, (action, tuple(args)))
+        logging.info(f"Загружено параметров кнопок: {len(rows)}")
+
+    async def flush(self) -> None:
+        """Сохраняет в базу токены, созданные или использованные с прошлого сохранения.
+
+        Как и в памяти, в базе хранится не больше maxsize последних использованных токенов.
+        """
+        if not self._unsaved:
+            return
+        now = time.time()
+        rows = [(token, _dump(payload), now) for token, payload in self._unsaved.items()]
+        self._unsaved = {}
+        await database.save_callback_payloads(rows, self.maxsize)
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+
+registry = CallbackRegistry()
+_routes: Dict[str, Handler] = {}
+
+
+def route(action: str, handler: Handler) -> None:
+    """Регистрирует обработчик действия; он получает параметры кнопки позиционными аргументами."""
+    _routes[action] = handler
+
+
+def encode(action: str, *args) -> str:
+    return registry.encode(action, *args)
+
+
+def keep_alive(markup: InlineKeyboardMarkup) -> bool:
+    """Продлевает жизнь токенов кнопок клавиатуры из кэша.
+
+    Возвращает False, если хотя бы один токен уже вытеснен и клавиатуру нужно
+    построить заново.
+    """
+    return all(registry.touch(button.callback_data) for row in markup.inline_keyboard for button in row
+               if isinstance(button.callback_data, str))
+
+
+async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Единая точка входа для всех нажатий inline-кнопок."""
+    query = update.callback_query
+    payload = await registry.resolve(query.data or '')
+    handler = _routes.get(payload[0]) if payload else None
+    if handler is None:
+        await query.answer("Кнопка устарела, начните поиск заново.", show_alert=True)
+        return
+    await handler(update, context, *payload[1])
@@ -0,0 +1,132 @@
+import asyncio
+import bisect
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import database
+from database import Game
+
+
+class Catalog:
+    """Снимок каталога игр в памяти: строки по id, индекс жанр -> id, список жанров."""
+
+    def __init__(self) -> None:
+        self.version = 0
+        self.source_version = None
+        self.loaded = False
+        self._games: Dict[int, Game] = {}
+        self._genre_ids: Dict[str, List[int]] = {}
+        self._genre_keys: Dict[str, List[tuple]] = {}
+        self._genres: List[str] = []
+
+    @staticmethod
+    def _sort_key(game: Game) -> tuple:
+        return game.name.casefold(), game.id
+
+    @classmethod
+    def _build_index(cls, games: List[Game]) -> tuple:
+        """Строит индексы каталога; не трогает self, поэтому выполняется вне цикла событий."""
+        by_genre: Dict[str, List[Game]] = {}
+        for game in games:
+            by_genre.setdefault(game.genre, []).append(game)
+
+        genre_ids, genre_keys = {}, {}
+        for genre, genre_games in by_genre.items():
+            genre_games.sort(key=cls._sort_key)
+            genre_ids[genre] = [game.id for game in genre_games]
+            genre_keys[genre] = [cls._sort_key(game) for game in genre_games]
+        return {game.id: game for game in games}, genre_ids, genre_keys, sorted(by_genre)
+
+    async def _rebuild(self, games: List[Game]) -> None:
+        index = await asyncio.get_running_loop().run_in_executor(None, self._build_index, games)
+        self._games, self._genre_ids, self._genre_keys, self._genres = index
+        self.version += 1
+        self.loaded = True
+
+    async def load(self) -> None:
+        """Полностью перечитывает каталог из базы данных.
+
+        Версия читается до игр: если запись в базу придется на время чтения,
+        версия в базе окажется новее запомненной, и следующая проверка
+        перечитает каталог снова.
+        """
+        version = await database.fetch_catalog_version()
+        games = await database.fetch_all_games()
+        await self._rebuild(games)
+        self.source_version = version
+        logging.info(f"Каталог загружен: {len(self._games)} игр, {len(self._genres)} жанров, версия {self.version}")
+
+    async def reload_if_changed(self) -> bool:
+        """Перечитывает каталог, если база была пересоздана или дополнена извне."""
+        if await database.fetch_catalog_version() == self.source_version:
+            return False
+        await self.load()
+        return True
+
+    def add(self, game: Game) -> None:
+        """Добавляет игру в снимок без полной перестройки индексов."""
+        previous = self._games.get(game.id)
+        if previous is not None:
+            self._remove_from_index(previous)
+        self._games[game.id] = game
+        if game.genre not in self._genre_ids:
+            self._genre_ids[game.genre] = []
+            self._genre_keys[game.genre] = []
+            bisect.insort(self._genres, game.genre)
+        key = self._sort_key(game)
+        position = bisect.bisect_left(self._genre_keys[game.genre], key)
+        self._genre_keys[game.genre].insert(position, key)
+        self._genre_ids[game.genre].insert(position, game.id)
+        self.version += 1
+
+    def apply(self, game: Game, version: int) -> None:
+        """Применяет запись, сделанную этим процессом, и запоминает новую версию базы.
+
+        Если версия выросла больше чем на единицу, базу параллельно изменил
+        кто-то еще, и source_version не трогается, чтобы проверка версии
+        перечитала каталог целиком.
+        """
+        if self.source_version is not None and version == self.source_version + 1:
+            self.source_version = version
+        self.add(game)
+
+    def _remove_from_index(self, game: Game) -> None:
+        keys = self._genre_keys[game.genre]
+        position = bisect.bisect_left(keys, self._sort_key(game))
+        del keys[position]
+        del self._genre_ids[game.genre][position]
+        if not keys:
+            del self._genre_keys[game.genre]
+            del self._genre_ids[game.genre]
+            self._genres.remove(game.genre)
+
+    def get(self, game_id: int) -> Optional[Game]:
+        return self._games.get(game_id)
+
+    def genres(self) -> List[str]:
+        return self._genres
+
+    def genres_page(self, page: int, per_page: int) -> Tuple[List[str], bool]:
+        """Возвращает жанры страницы и признак наличия следующей страницы."""
+        start = page * per_page
+        window = self._genres[start:start + per_page + 1]
+        return window[:per_page], len(window) > per_page
+
+    def games_page(self, genre: str, page: int, per_page: int) -> Tuple[List[Game], bool]:
+        """Возвращает игры страницы жанра и признак наличия следующей страницы.
+
+        Копируется только окно из per_page + 1 id, поэтому любая страница стоит
+        столько же, сколько первая.
+        """
+        start = page * per_page
+        window = self._genre_ids.get(genre, [])[start:start + per_page + 1]
+        return [self._games[game_id] for game_id in window[:per_page]], len(window) > per_page
+
+    def names(self) -> List[str]:
+        return [game.name for game in self._games.values()]
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+
+catalog = Catalog()
@@ -0,0 +1,326 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import dp
+import metrics
+from dp import bump_catalog_version
+
+DB_PATH = 'games.db'
+POOL_SIZE = 4
+LOAD_BATCH_SIZE = 5000
+# Жанр для игр, у которых он не заполнен (старые записи или запись в базу извне).
+NO_GENRE = 'Без жанра'
+
+
+class Game(NamedTuple):
+    id: int
+    name: str
+    genre: str
+    steam_link: Optional[str]
+    gog_link: Optional[str]
+    epic_link: Optional[str]
+
+    @classmethod
+    def from_row(cls, row) -> 'Game':
+        """Строка таблицы games; пустой жанр заменяется на NO_GENRE."""
+        game = cls(*row)
+        return game if game.genre else game._replace(genre=NO_GENRE)
+
+
+_db_path = DB_PATH
+_pool_size = POOL_SIZE
+_executor: Optional[ThreadPoolExecutor] = None
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+
+
+def configure(path: str = DB_PATH, pool_size: int = POOL_SIZE) -> None:
+    """Задает путь к базе и размер пула соединений. Вызывается при запуске бота."""
+    global _db_path, _pool_size
+    close()
+    _db_path = path
+    _pool_size = pool_size
+
+
+def close() -> None:
+    """Останавливает пул потоков и закрывает все открытые соединения."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.__dict__.clear()
+
+
+def connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """Открывает соединение с базой в режиме WAL."""
+    conn = sqlite3.connect(path or _db_path, check_same_thread=False, cached_statements=128)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def migrate() -> int:
+    """Доводит схему базы до актуальной версии."""
+    conn = connect()
+    try:
+        return dp.migrate(conn)
+    finally:
+        conn.close()
+
+
+def _connection() -> sqlite3.Connection:
+    """Возвращает соединение, закрепленное за текущим потоком пула."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = connect()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_pool_size, thread_name_prefix='db')
+    return _executor
+
+
+async def _run(operation: str, func, *args):
+    """Выполняет синхронную функцию в пуле потоков базы данных.
+
+    Время запроса пишется в метрику с меткой operation - именем публичной
+    функции модуля (fetch_games_page, search_titles ...), а не общего _fetch_all.
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_get_executor(), func, *args)
+    finally:
+        metrics.SQLITE_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+
+_FTS_TOKEN = re.compile(r'(\w+)(\*?)')
+
+
+def fts_query(text: str) -> Optional[str]:
+    """Строит запрос FTS5 по названию: все слова обязательны, последнее и слова с * - префиксы."""
+    tokens = _FTS_TOKEN.findall(text)
+    if not tokens:
+        return None
+    terms = []
+    for index, (word, star) in enumerate(tokens):
+        prefix = star or index == len(tokens) - 1
+        terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return f"name : ({' '.join(terms)})"
+
+
+def _fetch_all(sql: str, params: tuple = ()) -> list:
+    return _connection().execute(sql, params).fetchall()
+
+
+def _fetch_one(sql: str, params: tuple = ()):
+    return _connection().execute(sql, params).fetchone()
+
+
+def _insert_game(name, genre, steam_link, gog_link, epic_link) -> Tuple[Game, int]:
+    conn = _connection()
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO games (name, genre, steam_link, gog_link, epic_link) VALUES (?, ?, ?, ?, ?)",
+            (name, genre, steam_link, gog_link, epic_link))
+        game = Game(cursor.lastrowid, name, genre, steam_link, gog_link, epic_link)
+        version = bump_catalog_version(cursor)
+    return game, version
+
+
+async def fetch_games_page(after: Optional[Tuple[str, str]] = None, limit: int = LOAD_BATCH_SIZE) -> List[Game]:
+    """Возвращает следующую порцию игр в порядке (жанр, название) после ключа after.
+
+    Keyset-пагинация по индексу idx_games_genre_name: стоимость любой порции
+    не зависит от ее номера. Жанр возвращается как есть: игры без жанра (NULL)
+    идут первыми, и ключ after для них - (None, название).
+    """
+    columns = "SELECT id, name, genre, steam_link, gog_link, epic_link FROM games"
+    if after is None:
+        rows = await _run('fetch_games_page', _fetch_all, f"{columns} ORDER BY genre, name LIMIT ?", (limit,))
+    elif after[0] is None:
+        # Сравнение с NULL в (genre, name) > (?, ?) ложно, поэтому хвост игр без жанра выбирается отдельно.
+        rows = await _run('fetch_games_page', _fetch_all,
+                          f"{columns} WHERE (genre IS NULL AND name > ?) OR genre IS NOT NULL "
+                          f"ORDER BY genre, name LIMIT ?", (after[1], limit))
+    else:
+        rows = await _run('fetch_games_page', _fetch_all,
+                          f"{columns} WHERE (genre, name) > (?, ?) ORDER BY genre, name LIMIT ?",
+                          (*after, limit))
+    return [Game(*row) for row in rows]
+
+
+async def fetch_all_games(batch_size: int = LOAD_BATCH_SIZE) -> List[Game]:
+    """Возвращает все игры каталога, читая их порциями, чтобы не занимать поток базы надолго."""
+    games: List[Game] = []
+    after = None
+    while True:
+        batch = await fetch_games_page(after, batch_size)
+        games.extend(map(Game.from_row, batch))
+        if len(batch) < batch_size:
+            return games
+        after = (batch[-1].genre, batch[-1].name)
+
+
+async def fetch_catalog_version() -> int:
+    """Возвращает версию каталога, которую увеличивает каждая запись в таблицу games."""
+    row = await _run('fetch_catalog_version', _fetch_one, "SELECT value FROM meta WHERE key = 'catalog_version'")
+    return row[0] if row else 0
+
+
+async def search_titles(text: str, limit: int = 5) -> List[str]:
+    """Ищет названия игр полнотекстовым индексом, лучшие совпадения первыми."""
+    match = fts_query(text)
+    if match is None:
+        return []
+    rows = await _run('search_titles', _fetch_all,
+                      "SELECT name FROM games_fts WHERE games_fts MATCH ? ORDER BY rank LIMIT ?",
+                      (match, limit))
+    return [row[0] for row in rows]
+
+
+async def fetch_search_cache(since: float, limit: int) -> List[Tuple[str, str, str, float]]:
+    """Возвращает сохраненные после since результаты веб-поиска, более старые первыми."""
+    rows = await _run('fetch_search_cache', _fetch_all,
+                      "SELECT name, store_filter, result, fetched_at FROM search_cache "
+                      "WHERE fetched_at >= ? ORDER BY fetched_at DESC LIMIT ?",
+                      (since, limit))
+    return rows[::-1]
+
+
+def _save_search_result(name, store_filter, result, fetched_at, expire_before) -> None:
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO search_cache (name, store_filter, result, fetched_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(name, store_filter) DO UPDATE SET result = excluded.result, fetched_at = excluded.fetched_at",
+            (name, store_filter, result, fetched_at))
+        if expire_before is not None:
+            conn.execute("DELETE FROM search_cache WHERE fetched_at < ?", (expire_before,))
+
+
+async def save_search_result(name: str, store_filter: str, result: str, fetched_at: float,
+                             expire_before: Optional[float] = None) -> None:
+    """Сохраняет результат веб-поиска (в JSON) для использования после перезапуска.
+
+    Результаты, полученные раньше expire_before, удаляются в той же транзакции.
+    """
+    await _run('save_search_result', _save_search_result, name, store_filter, result, fetched_at, expire_before)
+
+
+async def fetch_games_missing_links(limit: int, checked_before: float) -> List[Game]:
+    """Возвращает игры без ссылки хотя бы на один магазин, самые популярные первыми.
+
+    Игры, которые уже проверялись после checked_before, пропускаются.
+    """
+    rows = await _run('fetch_games_missing_links', _fetch_all,
+                      "SELECT id, name, genre, steam_link, gog_link, epic_link FROM games "
+                      "WHERE (steam_link IS NULL OR gog_link IS NULL OR epic_link IS NULL) "
+                      "AND (links_checked_at IS NULL OR links_checked_at < ?) "
+                      "ORDER BY request_count DESC, id LIMIT ?",
+                      (checked_before, limit))
+    return [Game.from_row(row) for row in rows]
+
+
+def _add_request_counts(counts) -> None:
+    conn = _connection()
+    with conn:
+        conn.executemany("UPDATE games SET request_count = request_count + ? WHERE id = ?",
+                         [(count, game_id) for game_id, count in counts.items()])
+
+
+async def add_request_counts(counts: Dict[int, int]) -> None:
+    """Прибавляет накопленные счетчики обращений к играм."""
+    await _run('add_request_counts', _add_request_counts, counts)
+
+
+def _update_game_links(game_id, steam_link, gog_link, epic_link, checked_at) -> Tuple[Optional[Game], Optional[int]]:
+    conn = _connection()
+    select = "SELECT id, name, genre, steam_link, gog_link, epic_link FROM games WHERE id = ?"
+    with conn:
+        before = conn.execute(select, (game_id,)).fetchone()
+        cursor = conn.execute(
+            "UPDATE games SET steam_link = COALESCE(steam_link, ?), gog_link = COALESCE(gog_link, ?), "
+            "epic_link = COALESCE(epic_link, ?), links_checked_at = ?, "
+            "links_updated_at = CASE WHEN ? IS NULL AND ? IS NULL AND ? IS NULL THEN links_updated_at ELSE ? END "
+            "WHERE id = ?",
+            (steam_link, gog_link, epic_link, checked_at, steam_link, gog_link, epic_link, checked_at, game_id))
+        row = cursor.execute(select, (game_id,)).fetchone()
+        if row is None or row == before:
+            return None, None
+        version = bump_catalog_version(cursor)
+    return Game.from_row(row), version
+
+
+async def update_game_links(game_id: int, steam_link: Optional[str], gog_link: Optional[str],
+                            epic_link: Optional[str], checked_at: float) -> Tuple[Optional[Game], Optional[int]]:
+    """Заполняет недостающие ссылки игры (существующие не перезаписываются).
+
+    Возвращает обновленную игру и новую версию каталога. Если ни одна ссылка
+    не добавилась, отмечается только время проверки, версия каталога не
+    меняется и возвращается (None, None).
+    """
+    return await _run('update_game_links', _update_game_links,
+                      game_id, steam_link, gog_link, epic_link, checked_at)
+
+
+async def fetch_callback_payloads(limit: int) -> List[Tuple[str, str]]:
+    """Возвращает limit последних сохраненных параметров кнопок, более старые первыми."""
+    rows = await _run('fetch_callback_payloads', _fetch_all,
+                      "SELECT token, payload FROM callback_payloads ORDER BY created_at DESC LIMIT ?", (limit,))
+    return rows[::-1]
+
+
+async def fetch_callback_payload(token: str) -> Optional[str]:
+    """Возвращает параметры кнопки (в JSON) по токену или None."""
+    row = await _run('fetch_callback_payload', _fetch_one,
+                     "SELECT payload FROM callback_payloads WHERE token = ?", (token,))
+    return row[0] if row else None
+
+
+def _save_callback_payloads(rows, keep) -> None:
+    conn = _connection()
+    with conn:
+        conn.executemany("INSERT INTO callback_payloads (token, payload, created_at) VALUES (?, ?, ?) "
+                         "ON CONFLICT(token) DO UPDATE SET created_at = excluded.created_at", rows)
+        if keep is not None:
+            conn.execute(
+                "DELETE FROM callback_payloads WHERE created_at < "
+                "(SELECT created_at FROM callback_payloads ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+                (keep - 1,))
+
+
+async def save_callback_payloads(rows: List[Tuple[str, str, float]], keep: Optional[int] = None) -> None:
+    """Сохраняет параметры кнопок (token, payload в JSON, created_at).
+
+    Для уже сохраненного токена created_at обновляется, так что это время его
+    последнего использования. Если задан keep, в таблице остаются только keep
+    самых свежих записей.
+    """
+    await _run('save_callback_payloads', _save_callback_payloads, rows, keep)
+
+
+async def insert_game(name: str, genre: str, steam_link: Optional[str], gog_link: Optional[str],
+                      epic_link: Optional[str]) -> Tuple[Game, int]:
+    """Добавляет игру и возвращает ее вместе с новой версией каталога.
+
+    Ошибки sqlite3 пробрасываются вызывающему.
+    """
+    return await _run('insert_game', _insert_game, name, genre, steam_link, gog_link, epic_link)
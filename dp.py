@@ -1,11 +1,10 @@
 import sqlite3
 
-
-def create_database():
-    conn = sqlite3.connect('games.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
+# Каждая миграция - список SQL-команд; номер миграции равен ее позиции + 1
+# и хранится в PRAGMA user_version.
+MIGRATIONS = [
+    [
+        '''
         CREATE TABLE IF NOT EXISTS games (
             id INTEGER PRIMARY KEY,
             name TEXT UNIQUE,
@@ -15,9 +14,104 @@ def create_database():
             gog_link TEXT,
             epic_link TEXT
         )
-    ''')
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+        ''',
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_games_genre_name ON games (genre, name)",
+    ],
+    [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS games_fts USING fts5(
+            name, genre, content='games', content_rowid='id'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS games_fts_insert AFTER INSERT ON games BEGIN
+            INSERT INTO games_fts (rowid, name, genre) VALUES (new.id, new.name, new.genre);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS games_fts_delete AFTER DELETE ON games BEGIN
+            INSERT INTO games_fts (games_fts, rowid, name, genre) VALUES ('delete', old.id, old.name, old.genre);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS games_fts_update AFTER UPDATE OF name, genre ON games BEGIN
+            INSERT INTO games_fts (games_fts, rowid, name, genre) VALUES ('delete', old.id, old.name, old.genre);
+            INSERT INTO games_fts (rowid, name, genre) VALUES (new.id, new.name, new.genre);
+        END
+        """,
+        "INSERT INTO games_fts (games_fts) VALUES ('rebuild')",
+    ],
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS search_cache (
+            name TEXT NOT NULL,
+            store_filter TEXT NOT NULL,
+            result TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (name, store_filter)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_search_cache_fetched_at ON search_cache (fetched_at)",
+    ],
+    [
+        "ALTER TABLE games ADD COLUMN request_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE games ADD COLUMN links_checked_at REAL",
+        "ALTER TABLE games ADD COLUMN links_updated_at REAL",
+    ],
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS callback_payloads (
+            token TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_callback_payloads_created_at ON callback_payloads (created_at)",
+    ],
+]
 
 
+def migrate(conn):
+    """Применяет к базе недостающие миграции и возвращает номер итоговой версии схемы."""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, statements in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        current = version
+    return current
+
+
+def bump_catalog_version(cursor):
+    """Увеличивает версию каталога, чтобы запущенный бот перечитал его."""
+    cursor.execute(
+        "INSERT INTO meta (key, value) VALUES ('catalog_version', 1) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+    cursor.execute("SELECT value FROM meta WHERE key = 'catalog_version'")
+    return cursor.fetchone()[0]
+
+
+def create_database():
+    conn = sqlite3.connect('games.db')
+    migrate(conn)
+    cursor = conn.cursor()
+
     games = [
         ("The Witcher 3: Wild Hunt", "PC", "RPG", "https://store.steampowered.com/app/292030/The_Witcher_3_Wild_Hunt/",
          "https://www.gog.com/game/the_witcher_3_wild_hunt",
@@ -270,14 +364,11 @@ def create_database():
         ("Path of Exile", "PC", "Action RPG", "https://store.steampowered.com/app/238960/Path_of_Exile/", None, None)
     ]
 
-    for game in games:
-        try:
-            cursor.execute(
-                "INSERT INTO games (name, platform, genre, steam_link, gog_link, epic_link) VALUES (?, ?, ?, ?, ?, ?)",
-                game)
-        except sqlite3.IntegrityError:
-            pass
+    cursor.executemany(
+        "INSERT OR IGNORE INTO games (name, platform, genre, steam_link, gog_link, epic_link) VALUES (?, ?, ?, ?, ?, ?)",
+        games)
 
+    bump_catalog_version(cursor)
     conn.commit()
     conn.close()
 
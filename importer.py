@@ -0,0 +1,127 @@
+import argparse
+import csv
+import itertools
+import json
+import sqlite3
+import sys
+import time
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from dp import bump_catalog_version, migrate
+
+BATCH_SIZE = 5000
+COLUMNS = ('name', 'platform', 'genre', 'steam_link', 'gog_link', 'epic_link')
+
+# Пустые поля не затирают уже известные ссылки и жанр.
+UPSERT_SQL = (
+    "INSERT INTO games (name, platform, genre, steam_link, gog_link, epic_link) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(name) DO UPDATE SET "
+    "platform = COALESCE(excluded.platform, platform), "
+    "genre = COALESCE(excluded.genre, genre), "
+    "steam_link = COALESCE(excluded.steam_link, steam_link), "
+    "gog_link = COALESCE(excluded.gog_link, gog_link), "
+    "epic_link = COALESCE(excluded.epic_link, epic_link)"
+)
+
+
+def _clean(value) -> Optional[str]:
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def read_records(stream: TextIO, fmt: str) -> Iterator[dict]:
+    """Построчно читает записи из CSV (с заголовком) или JSONL."""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def to_rows(records: Iterable[dict], skipped: Optional[List[int]] = None) -> Iterator[Tuple]:
+    """Превращает записи в строки для UPSERT_SQL.
+
+    Записи без названия или жанра пропускаются: игра без жанра не попадет ни
+    в один список жанров. Номера пропущенных записей (с 1) добавляются в skipped.
+    """
+    for number, record in enumerate(records, start=1):
+        row = tuple(_clean(record.get(column)) for column in COLUMNS)
+        if row[0] and row[2]:
+            yield row
+        elif skipped is not None:
+            skipped.append(number)
+
+
+def import_catalog(conn: sqlite3.Connection, rows: Iterable[Tuple], batch_size: int = BATCH_SIZE,
+                   progress=None) -> int:
+    """Загружает строки в games одной транзакцией пачками по batch_size.
+
+    В конце увеличивает версию каталога, чтобы запущенный бот перечитал его.
+    Возвращает число обработанных строк.
+    """
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-200000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    total = 0
+    rows = iter(rows)
+    conn.execute("BEGIN")
+    try:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            conn.executemany(UPSERT_SQL, batch)
+            total += len(batch)
+            if progress is not None:
+                progress(total)
+        bump_catalog_version(conn.cursor())
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return total
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Массовая загрузка каталога игр из CSV или JSONL.")
+    parser.add_argument('source', help="файл с каталогом или - для stdin")
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help="формат входных данных (по умолчанию - по расширению файла)")
+    parser.add_argument('--db', default='games.db')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ('jsonl' if args.source.endswith(('.jsonl', '.json')) else 'csv')
+    stream = sys.stdin if args.source == '-' else open(args.source, newline='', encoding='utf-8')
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate(conn)
+
+    started = time.perf_counter()
+
+    def progress(done: int) -> None:
+        elapsed = time.perf_counter() - started
+        print(f"\r{done} строк, {done / elapsed:.0f} строк/с", end='', file=sys.stderr)
+
+    skipped: List[int] = []
+    try:
+        total = import_catalog(conn, to_rows(read_records(stream, fmt), skipped), args.batch_size, progress)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        conn.close()
+    elapsed = time.perf_counter() - started
+    print(f"\nЗагружено {total} строк за {elapsed:.1f} с ({total / elapsed if elapsed else 0:.0f} строк/с)",
+          file=sys.stderr)
+    if skipped:
+        shown = ', '.join(map(str, skipped[:10])) + (' ...' if len(skipped) > 10 else '')
+        print(f"Пропущено {len(skipped)} записей без названия или жанра (номера: {shown})", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import contextvars
+import copy
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Библиотеки, которые на INFO пишут строку на каждый HTTP-запрос к Bot API.
+QUIET_LOGGERS = ('httpx', 'httpcore')
+
+REQUEST_ID: contextvars.ContextVar = contextvars.ContextVar('request_id', default=None)
+USER_ID: contextvars.ContextVar = contextvars.ContextVar('user_id', default=None)
+
+_listener: Optional[QueueListener] = None
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи id обновления и пользователя из контекста задачи, которая ее пишет."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = REQUEST_ID.get()
+        record.user_id = USER_ID.get()
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    """Кладет в очередь запись с уже подставленными аргументами, но без форматирования.
+
+    Трассировка исключения превращается в текст здесь, пока оно еще живо, а
+    формат (JSON или текст) применяет поток QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in ('request_id', 'user_id'):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def bind(update_id: Optional[int], user_id: Optional[int]) -> None:
+    """Запоминает id обновления и пользователя для всех записей текущей задачи."""
+    REQUEST_ID.set(update_id)
+    USER_ID.set(user_id)
+
+
+def setup(level=logging.INFO, fmt: str = 'json', stream=None) -> None:
+    """Настраивает логирование через очередь.
+
+    В цикле событий запись только кладется в очередь, а форматирование и
+    запись в поток выполняет отдельный поток QueueListener. fmt - 'json' или
+    'text'.
+    """
+    global _listener
+    shutdown()
+    if isinstance(level, str):
+        level = logging.getLevelName(level)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.WARNING))
+
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown() -> None:
+    """Дописывает оставшиеся в очереди записи и останавливает поток логирования."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
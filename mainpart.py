@@ -1,11 +1,17 @@
 import logging
-import sqlite3
 import asyncio
+import functools
+import html
+import io
+import json
+import os
 import time
 import random
-from fuzzywuzzy import process
+import sqlite3
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, Message, Update
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
@@ -15,23 +21,82 @@ from telegram.ext import (
     ConversationHandler,
     filters
 )
-from googlesearch import search
 from Config import TOKEN
+import database
+from cache import LRUCache, TTLCache
+from matcher import normalize
+import websearch
+import backfill
+import callbacks
+from updates import PerUserUpdateProcessor
+from throttle import UserSearchLimiter
+import snapshot
+import metrics
+import ratelimit
+import logconfig
+import profiler
 
 
 
-
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-
-REQUEST_DELAY_BASE = 2.0
-REQUEST_DELAY_FACTOR = 1.5
 MAX_RETRIES = 5
 RETRY_DELAY_BASE = 5
-SEARCH_CACHE = {}
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 6 * 60 * 60
+SEARCH_CACHE_NEGATIVE_TTL = 10 * 60
+SEARCH_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+SEARCH_CACHE = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_MAX_AGE)
+SEARCH_IN_FLIGHT: Dict[Tuple[str, str], 'SearchFlight'] = {}
+STREAM_SEARCH_RESULTS = True
+STREAM_EDIT_INTERVAL = 1.5
+MAX_SEARCHES_PER_USER = 1
+SEARCH_LIMITER = UserSearchLimiter(MAX_SEARCHES_PER_USER)
+DEBOUNCE_WINDOW = 1.0
+STORE_QUERY_PAGES = 2
+SEARCH_WORKERS = 4
+DB_PATH = 'games.db'
+DB_POOL_SIZE = 4
+CATALOG_CHECK_INTERVAL = 60
+BACKFILL_INTERVAL = 5 * 60
+CALLBACK_FLUSH_INTERVAL = 30
+# Режим получения обновлений: "polling" или "webhook". Для webhook бот поднимает
+# локальный HTTP-сервер на WEBHOOK_LISTEN:WEBHOOK_PORT, а WEBHOOK_URL - внешний
+# адрес (обычно reverse proxy), который регистрируется в Telegram.
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '16'))
+# Обновления делятся на полосы: дешевое листание каталога и долгий веб-поиск.
+# Поиску достается не больше SEARCH_LANE_WORKERS слотов из CONCURRENT_UPDATES,
+# а при SEARCH_LANE_QUEUE_LIMIT ожидающих новые поиски сразу отклоняются.
+SEARCH_LANE_WORKERS = int(os.environ.get('SEARCH_LANE_WORKERS', '4'))
+SEARCH_LANE_QUEUE_LIMIT = int(os.environ.get('SEARCH_LANE_QUEUE_LIMIT', '32'))
+SEARCH_ACTIONS = {"search", "store"}
+MENU_BUTTONS = {"Начать заново", "Добавить игру"}
+# Диалог добавления игры; задается в register_handlers, чтобы его шаги не попадали в полосу поиска.
+ADD_GAME_CONVERSATION: Optional[ConversationHandler] = None
+# Если задан каталог со снимками (python snapshot.py build --watch), процесс не
+# держит свою копию каталога и индекса, а читает общий снимок через mmap; так
+# можно запускать несколько рабочих процессов. Фоновый поиск ссылок в этом
+# режиме выключен: им занимается процесс без снимка.
+CATALOG_SNAPSHOT_DIR = os.environ.get('CATALOG_SNAPSHOT_DIR')
+SNAPSHOT_CHECK_INTERVAL = 10
+# Нажатие кнопки может попасть в другой процесс: он найдет параметры по токену
+# в базе, поэтому в этом режиме новые токены сохраняются почти сразу.
+SNAPSHOT_CALLBACK_FLUSH_INTERVAL = 1
+catalog, matcher = snapshot.open_catalog(CATALOG_SNAPSHOT_DIR)
+# Формат логов: "json" (по строке JSON на запись) или "text".
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Порт HTTP-эндпоинта /metrics на 127.0.0.1; 0 - не поднимать.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9108'))
+ADMIN_USER_ID = 210705050  # Замените на ID доверенного пользователя
+KEYBOARD_CACHE_SIZE = 512
+KEYBOARD_CACHE = LRUCache(KEYBOARD_CACHE_SIZE)
+MATCH_THRESHOLD = 50
+MAX_SUGGESTIONS = 3
 
 
 (
@@ -55,101 +120,108 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def get_genre_keyboard(page: int) -> InlineKeyboardMarkup:
-    """Получает список уникальных жанров из базы данных и формирует клавиатуру."""
-    conn = sqlite3.connect('games.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT genre FROM games")
-    genres = cursor.fetchall()
-    conn.close()
+    """Получает список уникальных жанров из каталога и формирует клавиатуру."""
+    cache_key = ('genres', None, page, catalog.version)
+    cached = KEYBOARD_CACHE.get(cache_key)
+    if cached is not None and callbacks.keep_alive(cached):
+        return cached
 
     genres_per_page = 4
-    start_index = page * genres_per_page
-    end_index = start_index + genres_per_page
-    current_genres = genres[start_index:end_index]
+    current_genres, has_next = catalog.genres_page(page, genres_per_page)
 
     keyboard = []
     for genre in current_genres:
-        keyboard.append([InlineKeyboardButton(genre[0], callback_data=f"genre_{genre[0]}_page_0")])
+        keyboard.append([InlineKeyboardButton(genre, callback_data=callbacks.encode("genre", genre, 0))])
 
     buttons = []
     if page > 0:
-        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"genres_page_{page - 1}"))
-    if end_index < len(genres):
-        buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=f"genres_page_{page + 1}"))
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=callbacks.encode("genres", page - 1)))
+    if has_next:
+        buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=callbacks.encode("genres", page + 1)))
     if buttons:
         keyboard.append(buttons)
 
-    return InlineKeyboardMarkup(keyboard)
+    markup = InlineKeyboardMarkup(keyboard)
+    KEYBOARD_CACHE.set(cache_key, markup)
+    return markup
+
+
+async def edit_markup(query, reply_markup: InlineKeyboardMarkup) -> None:
+    """Меняет клавиатуру сообщения, если она отличается от уже показанной."""
+    if query.message.reply_markup == reply_markup:
+        return
+    try:
+        await query.message.edit_reply_markup(reply_markup=reply_markup)
+    except BadRequest as e:
+        # Двойное нажатие: первое уже поменяло клавиатуру, а в сообщении кнопки - старая.
+        if 'not modified' not in str(e).lower():
+            raise
 
 
-async def show_genres_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def show_genres_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int) -> None:
     """Обрабатывает перелистывание страниц жанров"""
     query = update.callback_query
     await query.answer()
 
-    page = int(query.data.split("_")[-1])
-    await query.message.edit_reply_markup(reply_markup=await get_genre_keyboard(page))
+    await edit_markup(query, await get_genre_keyboard(page))
 
 
-async def show_games_by_genre(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Выводит список игр выбранного жанра."""
+async def show_games_by_genre(update: Update, context: ContextTypes.DEFAULT_TYPE, genre: str, page: int = 0,
+                              in_place: bool = False) -> None:
+    """Выводит список игр выбранного жанра.
+
+    Из списка жанров приходит новым сообщением, а "Вперед"/"Назад" (in_place)
+    меняют клавиатуру того же сообщения.
+    """
     query = update.callback_query
     await query.answer()
 
-    data = query.data.split("_")
-    genre = data[1]
-    page = int(data[-1]) if len(data) > 3 and data[-2] == "page" else 0
-
     keyboard = await get_games_keyboard(genre, page)
-    if keyboard:
+    if in_place:
+        await edit_markup(query, keyboard)
+    elif keyboard:
         await query.message.reply_text(f"Выбери игру жанра <b>{genre}</b>:", reply_markup=keyboard, parse_mode="HTML")
     else:
         await query.message.reply_text("Игры в этом жанре не найдены.")
 
 
 async def get_games_keyboard(genre: str, page: int) -> InlineKeyboardMarkup:
-    """Получает список игр из базы данных и формирует клавиатуру."""
-    conn = sqlite3.connect('games.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name FROM games WHERE genre=?", (genre,))
-    games = cursor.fetchall()
-    conn.close()
+    """Получает список игр из каталога и формирует клавиатуру."""
+    cache_key = ('games', genre, page, catalog.version)
+    cached = KEYBOARD_CACHE.get(cache_key)
+    if cached is not None and callbacks.keep_alive(cached):
+        return cached
 
     games_per_page = 5
-    start_index = page * games_per_page
-    end_index = start_index + games_per_page
-    current_games = games[start_index:end_index]
+    current_games, has_next = catalog.games_page(genre, page, games_per_page)
 
     keyboard = []
-    for game_id, game_name in current_games:
-        keyboard.append([InlineKeyboardButton(game_name, callback_data=f"game_{game_id}")])
+    for game in current_games:
+        keyboard.append([InlineKeyboardButton(game.name, callback_data=callbacks.encode("game", game.id))])
 
     buttons = []
     if page > 0:
-        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"genre_{genre}_page_{page - 1}"))
-    if end_index < len(games):
-        buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=f"genre_{genre}_page_{page + 1}"))
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=callbacks.encode("genre", genre, page - 1, True)))
+    if has_next:
+        buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=callbacks.encode("genre", genre, page + 1, True)))
     if buttons:
         keyboard.append(buttons)
 
-    return InlineKeyboardMarkup(keyboard)
+    markup = InlineKeyboardMarkup(keyboard)
+    KEYBOARD_CACHE.set(cache_key, markup)
+    return markup
 
 
-async def show_game_links(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def show_game_links(update: Update, context: ContextTypes.DEFAULT_TYPE, game_id: int) -> None:
     """Выводит ссылки на маркетплейсы для выбранной игры."""
     query = update.callback_query
     await query.answer()
 
-    game_id = query.data.split("_")[1]
-
-    conn = sqlite3.connect('games.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, steam_link, gog_link, epic_link FROM games WHERE id=?", (game_id,))
-    game = cursor.fetchone()
-    conn.close()
+    game = catalog.get(game_id)
+    backfill.record_game_request(game_id)
 
     if game:
-        name, steam_link, gog_link, epic_link = game
+        name, steam_link, gog_link, epic_link = game.name, game.steam_link, game.gog_link, game.epic_link
         message = f"Ссылки на покупку игры <b>{name}</b>:\n\n"
         stores = {
             'steam': [],
@@ -190,9 +262,75 @@ async def handle_start_button(update: Update, context: ContextTypes.DEFAULT_TYPE
     await start(update, context)
 
 
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает администратору сводку метрик бота."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав для выполнения этого действия.")
+        return
+    await update.message.reply_text(metrics.summary() + "\n\n" + runtime_summary(context.application),
+                                    parse_mode="HTML")
+
+
+def runtime_summary(application: Application) -> str:
+    """Кэши, очереди и ограничители для /stats - те же данные, что в метриках Prometheus."""
+    lines = ["<b>Кэши</b> (попадания, размер):"]
+    for name, cache in (('поиск', SEARCH_CACHE), ('клавиатуры', KEYBOARD_CACHE)):
+        stats = cache.stats()
+        lines.append(f"{name}: {stats['hit_rate']:.0%} из {stats['hits'] + stats['misses']}, {stats['size']} записей")
+
+    search = websearch.scheduler.stats()
+    lines.append(f"\n<b>Поисковик</b>: темп {search['rate']:.2f} запр/с, ответов 429: {search['throttled']}, "
+                 f"в очереди {search['queue_interactive']} + {search['queue_background']} фоновых")
+
+    processor = application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        lines.append("\n<b>Полосы</b> (выполняется / ждет / отклонено):")
+        lines.extend(f"{lane}: {processor.lane_running[lane]} / {processor.lane_waiting[lane]} / "
+                     f"{processor.shed[lane]}" for lane in processor.lanes)
+    limiter = application.bot.rate_limiter
+    if isinstance(limiter, ratelimit.TelegramRateLimiter):
+        lines.append(f"\n<b>Bot API</b>: ждут отправки {limiter.waiting}, повторов после 429: {limiter.retries}")
+    return '\n'.join(lines)
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Включает для администратора профилирование на N секунд или N обновлений и присылает отчет."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав для выполнения этого действия.")
+        return
+    if context.args and context.args[0].lower() == 'stop':
+        stopped = profiler.stop()
+        await update.message.reply_text("Профилирование остановлено, отчет сейчас придет." if stopped
+                                        else "Профилирование не запущено.")
+        return
+    try:
+        seconds, updates, threshold = profiler.parse_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(profiler.USAGE)
+        return
+
+    chat_id = update.effective_chat.id
+    bot = context.bot
+
+    async def send_report(report: str, raw: bytes) -> None:
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        await bot.send_document(chat_id, document=io.BytesIO(report.encode('utf-8')), filename=f'profile-{stamp}.txt',
+                                caption="Отчет профилирования")
+        await bot.send_document(chat_id, document=io.BytesIO(raw), filename=f'profile-{stamp}.prof')
+
+    try:
+        profiler.start(seconds, updates, threshold, send_report)
+    except RuntimeError as e:
+        await update.message.reply_text(str(e))
+        return
+    limit = f"{updates} обновлений (не дольше {seconds:g} с)" if updates else f"{seconds:g} с"
+    await update.message.reply_text(f"Профилирование запущено на {limit}, порог блокировки цикла "
+                                    f"{threshold * 1000:g} мс.")
+
+
 async def add_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Позволяет администратору добавить игру в базу данных."""
-    if update.message.from_user.id != 210705050:  # Замените на ID доверенных пользователей
+    if update.message.from_user.id != ADMIN_USER_ID:
         await update.message.reply_text("У вас нет прав для выполнения этого действия.")
         return ConversationHandler.END  # Stop the conversation
 
@@ -243,79 +381,21 @@ async def add_game_handle_epic(update: Update, context: ContextTypes.DEFAULT_TYP
         epic_link = None
     context.user_data['epic_link'] = epic_link
 
-    conn = sqlite3.connect('games.db')
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO games (name, genre, steam_link, gog_link, epic_link) VALUES (?, ?, ?, ?, ?)",
-                       (
-                       context.user_data['game_name'], context.user_data['game_genre'], context.user_data['steam_link'],
-                       context.user_data['gog_link'], context.user_data['epic_link']))
-        conn.commit()
+        game, version = await database.insert_game(context.user_data['game_name'], context.user_data['game_genre'],
+                                   context.user_data['steam_link'], context.user_data['gog_link'],
+                                   context.user_data['epic_link'])
+        catalog.apply(game, version)
+        matcher.add(game.name)
+        KEYBOARD_CACHE.clear()
         await update.message.reply_text("Игра добавлена в базу данных.")
     except Exception as e:
         await update.message.reply_text(f"Ошибка добавления игры: {e}")
     finally:
-        conn.close()
         context.user_data.clear()
     return ConversationHandler.END
 
 
-async def search_page(query, page_num):
-    """
-    Implements pagination for your search.
-    Crucially, you MUST adapt this function to the output format of your `google_search` library.
-    """
-    logging.info(f"Поисковый запрос: {query}, страница: {page_num}")
-    try:
-        results_generator = search(query, start=(page_num * 5))
-        results_from_page = list(results_generator)
-        if results_from_page:
-            logging.info(f"Результаты поиска (страница {page_num}):")
-            for i, result in enumerate(results_from_page):
-                if isinstance(result, str):
-                    logging.info(f"   {i}: str: {result}")
-                else:
-                    if hasattr(result, 'link') and hasattr(result, 'name'):
-                        logging.info(f"   {i}: link: {result.link}, name: {result.name}")
-                    else:
-                        logging.info(f"  {i}: unknown: {result}")
-        else:
-            logging.info(f"Результаты поиска (страница {page_num}): нет результатов")
-        return results_from_page
-
-    except Exception as e:
-        logging.error(f"Ошибка при пагинации: {e}")
-        return []
-
-
-async def search_page_multiple_words(query_words, page_num):
-    """
-    Implements pagination for your search, now with multiple words.
-    """
-    query = " ".join(query_words)
-    logging.info(f"Поисковый запрос (несколько слов): {query}, страница: {page_num}")
-    try:
-        results_generator = search(query, start=(page_num * 5))
-        results_from_page = list(results_generator)
-        if results_from_page:
-            logging.info(f"Результаты поиска (страница {page_num}):")
-            for i, result in enumerate(results_from_page):
-                if isinstance(result, str):
-                    logging.info(f"   {i}: str: {result}")
-                else:
-                    if hasattr(result, 'link') and hasattr(result, 'name'):
-                        logging.info(f"   {i}: link: {result.link}, name: {result.name}")
-                    else:
-                        logging.info(f"  {i}: unknown: {result}")
-        else:
-            logging.info(f"Результаты поиска (страница {page_num}): нет результатов")
-        return results_from_page
-
-    except Exception as e:
-        logging.error(f"Ошибка при пагинации (несколько слов): {e}")
-        return []
-
-
 async def search_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Ищет игру в интернете и выводит ссылки на магазины."""
     user_query = update.message.text
@@ -323,142 +403,325 @@ async def search_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await start(update, context)
         return
 
-    if user_query in SEARCH_CACHE:
-        await update.message.reply_text(SEARCH_CACHE[user_query], parse_mode='HTML')
-        return
-
-    current_delay = REQUEST_DELAY_BASE
-    retries_left = MAX_RETRIES
-
-    conn = sqlite3.connect('games.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM games")
-    game_names = [row[0] for row in cursor.fetchall()]
-    conn.close()
-
-    best_match, score = process.extractOne(user_query, game_names)
-    if score < 50:  # Adjust threshold as needed
+    matches = await database.search_titles(user_query, MAX_SUGGESTIONS)
+    if not matches:
+        matches = [name for name, score in matcher.match(user_query, MAX_SUGGESTIONS) if score >= MATCH_THRESHOLD]
+    if not matches:
         await update.message.reply_text(
             f"Не найдено точных совпадений для '{user_query}'. Попробуйте ввести точное название.")
         return
 
-    if best_match != user_query:
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"Искать '{user_query}'", callback_data=f"search_original_{user_query}"),
-             InlineKeyboardButton(f"Искать '{best_match}'", callback_data=f"search_best_{best_match}")],
-        ])
+    best_match = matches[0]
+    if best_match.casefold() != user_query.casefold():
+        keyboard = [[InlineKeyboardButton(f"Искать '{user_query}'", callback_data=callbacks.encode("search", "original", user_query))]]
+        for name in matches:
+            keyboard.append([InlineKeyboardButton(f"Искать '{name}'", callback_data=callbacks.encode("search", "best", name))])
+        suggestions = ", ".join(f"'{name}'" for name in matches)
         await update.message.reply_text(
-            f"Вы ввели '{user_query}', возможно вы имели ввиду '{best_match}'. Какой вариант использовать для поиска?",
-            reply_markup=keyboard)
+            f"Вы ввели '{user_query}', возможно вы имели ввиду {suggestions}. Какой вариант использовать для поиска?",
+            reply_markup=InlineKeyboardMarkup(keyboard))
         return  # Stop processing here and wait for a callback
     else:
         keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Любой", callback_data=f"store_filter_any_{user_query}"),
-             InlineKeyboardButton("Steam", callback_data=f"store_filter_steam_{user_query}"),
-             InlineKeyboardButton("GOG", callback_data=f"store_filter_gog_{user_query}"),
-             InlineKeyboardButton("Epic", callback_data=f"store_filter_epic_{user_query}")],
+            [InlineKeyboardButton("Любой", callback_data=callbacks.encode("store", "any", best_match)),
+             InlineKeyboardButton("Steam", callback_data=callbacks.encode("store", "steam", best_match)),
+             InlineKeyboardButton("GOG", callback_data=callbacks.encode("store", "gog", best_match)),
+             InlineKeyboardButton("Epic", callback_data=callbacks.encode("store", "epic", best_match))],
         ])
-        await update.message.reply_text(f"Вы ввели '{user_query}'. Выберите магазин или оставьте любой:",
+        await update.message.reply_text(f"Вы ввели '{best_match}'. Выберите магазин или оставьте любой:",
                                         reply_markup=keyboard)
         return  # Stop processing here and wait for a callback
 
 
-async def perform_search(update: Update, context: ContextTypes.DEFAULT_TYPE, game_name, store_filter=None) -> None:
-    """Выполняет поиск игры в интернете."""
-    current_delay = REQUEST_DELAY_BASE
+class SearchResult(NamedTuple):
+    links: List[str]
+    stores: Dict[str, List[str]]
+    # False, если хотя бы одна страница выдачи не получена: такой результат не кэшируется.
+    complete: bool = True
+
+
+def search_cache_key(game_name: str, store_filter: Optional[str]) -> Tuple[str, str]:
+    """Ключ кэша поиска: нормализованное название и магазин."""
+    return normalize(game_name), store_filter or 'any'
+
+
+async def collect_search_results(game_name: str, store_filter: Optional[str],
+                                 priority: int = websearch.INTERACTIVE,
+                                 on_progress: Optional[Callable[[SearchResult], None]] = None) -> SearchResult:
+    """Собирает ссылки на игру в магазинах.
+
+    Для каждого нужного магазина параллельно выполняется свой site:-запрос;
+    поиск по магазину прекращается, как только найдена ссылка на страницу игры.
+    on_progress, если передан, получает промежуточный результат после каждой страницы.
+    """
+    stores = {store: [] for store in websearch.STORE_SITES}
+    failed = set()
+
+    def snapshot() -> SearchResult:
+        ordered = {store: sorted(links, key=lambda link: not websearch.is_canonical_link(store, link))
+                   for store, links in stores.items()}
+        return SearchResult([link for links in ordered.values() for link in links], ordered, not failed)
+
+    async def search_store(store: str, query: str) -> None:
+        for page_num in range(STORE_QUERY_PAGES):
+            try:
+                page_results = await websearch.search_page(query, page_num, priority)
+            except websearch.SearchPageFailed:
+                failed.add(store)
+                return
+            for link in page_results:
+                found = websearch.classify_link(link)
+                if found is None or (store_filter and found != store_filter):
+                    continue
+                if link not in stores[found] and len(stores[found]) < 5:
+                    stores[found].append(link)
+            if on_progress is not None:
+                on_progress(snapshot())
+            if not page_results or any(websearch.is_canonical_link(store, link) for link in stores[store]):
+                return
+
+    tasks = [asyncio.ensure_future(search_store(store, query))
+             for store, query in websearch.plan_queries(game_name, store_filter)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return snapshot()
+
+
+def format_search_result(game_name: str, result: SearchResult) -> str:
+    """Формирует HTML-сообщение со ссылками, найденными поиском."""
+    if not result.links and not result.complete:
+        return "Поисковик сейчас недоступен, попробуйте позже."
+    if not result.links:
+        return f"Не удалось найти ссылки на игру '{html.escape(game_name)}'."
+
+    def anchor(link: str) -> str:
+        escaped = html.escape(link)
+        return f"<a href='{escaped}'> {escaped}</a>\n"
+
+    message = f"Ссылки на покупку игры <b>{html.escape(game_name)}</b>:\n\n"
+    message += "".join(anchor(link) for link in result.links[:5])
+
+    for store, links in result.stores.items():
+        if links:
+            message += f"\n<b>{store}:</b>\n"
+            message += "".join(anchor(link) for link in links[:5])
+    if not result.complete:
+        message += "\n<i>Часть магазинов не ответила, результат может быть неполным.</i>"
+    return message
+
+
+async def reply(update: Update, text: str, **kwargs) -> Message:
+    """Отвечает в чат, из которого пришло сообщение или нажатие кнопки."""
+    message = update.callback_query.message if update.callback_query else update.message
+    return await message.reply_text(text, **kwargs)
+
+
+class SearchFailed(Exception):
+    """Поиск не удался после всех повторных попыток."""
+
+
+def is_fresh(result: SearchResult, fetched_at: float) -> bool:
+    ttl = SEARCH_CACHE_TTL if result.links else SEARCH_CACHE_NEGATIVE_TTL
+    return time.time() - fetched_at < ttl
+
+
+def remember_search_result(cache_key: Tuple[str, str], result: SearchResult, fetched_at: float) -> None:
+    """Кладет результат в кэш в памяти; запись живет, пока ее можно отдавать устаревшей."""
+    ttl = SEARCH_CACHE_MAX_AGE - (time.time() - fetched_at)
+    if ttl > 0:
+        SEARCH_CACHE.set(cache_key, (result, fetched_at), ttl=ttl)
+
+
+async def load_search_cache() -> None:
+    """Загружает сохраненные результаты поиска, чтобы после перезапуска кэш не был пустым."""
+    rows = await database.fetch_search_cache(time.time() - SEARCH_CACHE_MAX_AGE, SEARCH_CACHE_SIZE)
+    for name, store_filter, payload, fetched_at in rows:
+        data = json.loads(payload)
+        remember_search_result((name, store_filter), SearchResult(data['links'], data['stores']), fetched_at)
+    logging.info(f"Загружено сохраненных результатов поиска: {len(rows)}")
+
+
+async def search_with_retries(game_name: str, store_filter: Optional[str],
+                             priority: int = websearch.INTERACTIVE,
+                             on_progress: Optional[Callable[[SearchResult], None]] = None) -> SearchResult:
+    """Ищет ссылки на игру, повторяя запрос после ошибки 429.
+
+    Темп запросов задает общий планировщик websearch.scheduler, который сам
+    замедляется после 429; здесь добавляется только случайная пауза.
+    """
     retries_left = MAX_RETRIES
     while retries_left > 0:
         try:
-            await asyncio.sleep(current_delay)
-            search_results = []
-            displayed_links = 0
-            stores = {'steam': [], 'gog': [], 'epic': []}
-
-            query_words = game_name.split()  # Split the game name into words
-
-            for page_num in range(0, 10):
-                if displayed_links >= 5:
-                    break
-                page_results = await search_page_multiple_words(query_words, page_num)  # Use the multiple words search
-                if page_results:
-                    for result in page_results:
-                        if displayed_links >= 5:
-                            break
-                        if isinstance(result, str):
-                            if store_filter:
-                                if store_filter == "steam" and 'steam' not in result.lower():
-                                    continue
-                                elif store_filter == "gog" and 'gog' not in result.lower():
-                                    continue
-                                elif store_filter == "epic" and (
-                                        'epicgames' not in result.lower() and 'epic' not in result.lower()):
-                                    continue
-
-                            search_results.append(result)
-                            link = result.lower()
-                            if 'steam' in link and len(stores['steam']) < 5:
-                                stores['steam'].append(result)
-                            elif 'gog' in link and len(stores['gog']) < 5:
-                                stores['gog'].append(result)
-                            elif ('epicgames' in link or 'epic' in link) and len(stores['epic']) < 5:
-                                stores['epic'].append(result)
-                            displayed_links += 1
-                else:
-                    break
-
-            if search_results:
-                message = f"Ссылки на покупку игры <b>{game_name}</b>:\n\n"
-                for i, result in enumerate(search_results):
-                    if i >= 5:
-                        break
-                    if isinstance(result, str):
-                        message += f"<a href='{result}'> {result}</a>\n"
-
-                store_messages = {}
-                if stores['steam']:
-                    store_messages['steam'] = [f"<a href='{r}'> {r}</a>\n" for r in stores['steam'][:5]]
-                if stores['gog']:
-                    store_messages['gog'] = [f"<a href='{r}'> {r}</a>\n" for r in stores['gog'][:5]]
-                if stores['epic']:
-                    store_messages['epic'] = [f"<a href='{r}'> {r}</a>\n" for r in stores['epic'][:5]]
-
-                for store, links in store_messages.items():
-                    if links:
-                        message += f"\n<b>{store}:</b>\n"
-                        message += "".join(links)
-                if message:
-                    await update.callback_query.message.reply_text(message,
-                                                                   parse_mode='HTML') if update.callback_query else await update.message.reply_text(
-                        message, parse_mode='HTML')
-                    return
-            else:
-                await update.callback_query.message.reply_text(
-                    f"Не удалось найти ссылки на игру '{game_name}'.") if update.callback_query else await update.message.reply_text(
-                    f"Не удалось найти ссылки на игру '{game_name}'.")
-                return
+            return await collect_search_results(game_name, store_filter, priority, on_progress)
         except Exception as e:
-            if "429" in str(e):
-                logging.warning(f"Ошибка 429. Увеличиваем задержку...")
-                current_delay *= REQUEST_DELAY_FACTOR
-                retries_left -= 1
-                await asyncio.sleep(random.uniform(0, RETRY_DELAY_BASE))
-            else:
-                await update.callback_query.message.reply_text(
-                    f"Произошла ошибка при поиске: {e}") if update.callback_query else await update.message.reply_text(
-                    f"Произошла ошибка при поиске: {e}")
-                return
-    await update.callback_query.message.reply_text(
-        f"Не удалось выполнить поиск после {MAX_RETRIES} попыток.") if update.callback_query else await update.message.reply_text(
-        f"Не удалось выполнить поиск после {MAX_RETRIES} попыток.")
+            if "429" not in str(e):
+                raise
+            logging.warning("Ошибка 429. Повторяем запрос...")
+            retries_left -= 1
+            await asyncio.sleep(random.uniform(0, RETRY_DELAY_BASE))
+    raise SearchFailed(f"Не удалось выполнить поиск после {MAX_RETRIES} попыток.")
+
+
+class SearchFlight:
+    """Выполняющийся веб-поиск, результат и промежуточное состояние которого общие для всех ожидающих."""
+
+    def __init__(self) -> None:
+        self.task: Optional[asyncio.Task] = None
+        self.partial: Optional[SearchResult] = None
+
+    def update(self, partial: SearchResult) -> None:
+        self.partial = partial
+
+
+async def _refresh_search_result(game_name: str, store_filter: Optional[str], priority: int,
+                                 flight: SearchFlight) -> SearchResult:
+    cache_key = search_cache_key(game_name, store_filter)
+    result = await search_with_retries(game_name, store_filter, priority, flight.update)
+    if not result.complete:
+        # Сбой сети или таймаут - не повод неделю отдавать из кэша пустой или неполный ответ.
+        logging.warning(f"Поиск '{game_name}' выполнен не полностью, результат не кэшируется")
+        return result
+    fetched_at = time.time()
+    remember_search_result(cache_key, result, fetched_at)
+    try:
+        await database.save_search_result(*cache_key, json.dumps(result._asdict()), fetched_at,
+                                          fetched_at - SEARCH_CACHE_MAX_AGE)
+    except sqlite3.Error as e:
+        # Результат уже в памяти; без записи в базу он лишь не переживет перезапуск.
+        logging.warning(f"Не удалось сохранить результат поиска '{game_name}': {e}")
+    return result
+
+
+def _finish_search(cache_key: Tuple[str, str], task: asyncio.Task) -> None:
+    SEARCH_IN_FLIGHT.pop(cache_key, None)
+    if not task.cancelled():
+        task.exception()  # ошибку получают ожидающие; здесь только помечаем ее обработанной
+
+
+def start_search(game_name: str, store_filter: Optional[str],
+                 priority: int = websearch.INTERACTIVE) -> SearchFlight:
+    """Запускает веб-поиск или возвращает уже идущий поиск с тем же ключом.
+
+    Одинаковые одновременные запросы (то же нормализованное название и магазин)
+    объединяются: поиск выполняется один раз, остальные ждут его результата.
+    """
+    cache_key = search_cache_key(game_name, store_filter)
+    flight = SEARCH_IN_FLIGHT.get(cache_key)
+    if flight is None:
+        flight = SearchFlight()
+        flight.task = asyncio.ensure_future(_refresh_search_result(game_name, store_filter, priority, flight))
+        SEARCH_IN_FLIGHT[cache_key] = flight
+        flight.task.add_done_callback(functools.partial(_finish_search, cache_key))
+    return flight
+
+
+async def refresh_search_result(game_name: str, store_filter: Optional[str],
+                                priority: int = websearch.INTERACTIVE) -> SearchResult:
+    """Выполняет веб-поиск и сохраняет результат в кэше и в базе."""
+    flight = start_search(game_name, store_filter, priority)
+    # shield: отмена одного ожидающего не должна прерывать поиск для остальных.
+    return await asyncio.shield(flight.task)
+
+
+async def revalidate_search_result(game_name: str, store_filter: Optional[str]) -> None:
+    """Фоновое обновление устаревшей записи кэша."""
+    if search_cache_key(game_name, store_filter) in SEARCH_IN_FLIGHT:
+        return
+    try:
+        await refresh_search_result(game_name, store_filter, websearch.BACKGROUND)
+    except Exception as e:
+        logging.warning(f"Не удалось обновить результат поиска для '{game_name}': {e}")
+
+
+async def perform_search(update: Update, context: ContextTypes.DEFAULT_TYPE, game_name, store_filter=None) -> None:
+    """Выполняет поиск игры в интернете.
+
+    Свежий результат из кэша отдается сразу. Устаревший тоже отдается сразу,
+    а в фоне запускается его обновление. Одновременно у пользователя может
+    идти не больше MAX_SEARCHES_PER_USER веб-поисков, лишние отклоняются.
+    """
+    cached = SEARCH_CACHE.get(search_cache_key(game_name, store_filter))
+    if cached is not None:
+        result, fetched_at = cached
+        if not is_fresh(result, fetched_at):
+            context.application.create_task(revalidate_search_result(game_name, store_filter))
+        await reply(update, format_search_result(game_name, result), parse_mode='HTML')
+        return
+
+    user_id = update.effective_user.id if update.effective_user else None
+    if user_id is not None and not SEARCH_LIMITER.try_acquire(user_id):
+        await reply(update, "Подождите, предыдущий поиск еще не закончился.")
+        return
+    try:
+        if STREAM_SEARCH_RESULTS:
+            await stream_search(update, game_name, store_filter)
+            return
+
+        try:
+            result = await refresh_search_result(game_name, store_filter)
+        except SearchFailed as e:
+            await reply(update, str(e))
+            return
+        except Exception as e:
+            await reply(update, f"Произошла ошибка при поиске: {e}")
+            return
+        await reply(update, format_search_result(game_name, result), parse_mode='HTML')
+    finally:
+        if user_id is not None:
+            SEARCH_LIMITER.release(user_id)
+
+
+async def stream_search(update: Update, game_name: str, store_filter: Optional[str]) -> None:
+    """Сразу отправляет сообщение-заглушку и дописывает в него ссылки по мере их нахождения.
+
+    Сообщение редактируется не чаще раза в STREAM_EDIT_INTERVAL секунд и только
+    при изменении текста, чтобы не упираться в ограничения Telegram на правки.
+    """
+    flight = start_search(game_name, store_filter)
+    message = await reply(update, f"Ищу ссылки на игру <b>{html.escape(game_name)}</b>...", parse_mode='HTML')
+    shown = None
+    shown_partial = None
+
+    async def show(text: str, **kwargs) -> None:
+        nonlocal shown
+        if text == shown:
+            return
+        try:
+            await message.edit_text(text, **kwargs)
+            shown = text
+        except TelegramError as e:
+            logging.warning(f"Не удалось обновить сообщение с результатами поиска: {e}")
+
+    while True:
+        done, _ = await asyncio.wait({flight.task}, timeout=STREAM_EDIT_INTERVAL)
+        if done:
+            break
+        partial = flight.partial
+        if partial is not None and partial.links and partial is not shown_partial:
+            shown_partial = partial
+            await show(format_search_result(game_name, partial) + "\n<i>Поиск продолжается...</i>", parse_mode='HTML')
+
+    try:
+        result = flight.task.result()
+    except SearchFailed as e:
+        await show(str(e))
+        return
+    except Exception as e:
+        await show(f"Произошла ошибка при поиске: {e}")
+        return
+    await show(format_search_result(game_name, result), parse_mode='HTML')
 
 
-async def handle_search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, search_type: str,
+                                 game_name: str) -> None:
     """Обрабатывает callback запросы с выбором поискового запроса"""
     query = update.callback_query
     await query.answer()
-    data = query.data.split("_")
-    search_type = data[1]
-    game_name = "_".join(data[2:])
 
     if search_type == "original":
         await perform_search(update, context, game_name)
@@ -466,20 +729,75 @@ async def handle_search_callback(update: Update, context: ContextTypes.DEFAULT_T
         await perform_search(update, context, game_name)
 
 
-async def handle_store_filter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_store_filter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, store: str,
+                                       game_name: str) -> None:
     """Обрабатывает callback запросы с выбором магазина"""
     query = update.callback_query
     await query.answer()
-    data = query.data.split("_")
-    store_filter = data[2] if data[2] != "any" else None
-    game_name = "_".join(data[3:])
+    store_filter = store if store != "any" else None
     await perform_search(update, context, game_name, store_filter)
 
 
-def main() -> None:
-    """Запуск бота."""
-    application = Application.builder().token(TOKEN).build()
+async def on_startup(application: Application) -> None:
+    """Загружает каталог игр и кэш поиска перед началом обработки обновлений."""
+    await catalog.load()
+    if not CATALOG_SNAPSHOT_DIR:
+        await matcher.rebuild(catalog.names())
+    await load_search_cache()
+    await callbacks.registry.load()
+    if METRICS_PORT:
+        await metrics.serve(METRICS_PORT)
+
+
+async def check_catalog_version(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Перечитывает каталог, если база была перезаполнена (например, через dp.py) или вышел новый снимок."""
+    if await catalog.reload_if_changed():
+        KEYBOARD_CACHE.clear()
+        if not CATALOG_SNAPSHOT_DIR:
+            await matcher.rebuild(catalog.names())
+        logging.info("Каталог перечитан после изменения базы данных")
+
+
+async def resolve_store_links(game_name: str, stores: List[str]) -> Dict[str, List[str]]:
+    """Находит ссылки на игру только в магазинах stores для фонового дозаполнения базы."""
+    results = await asyncio.gather(*(collect_search_results(game_name, store, websearch.BACKGROUND)
+                                     for store in stores))
+    if not all(result.complete for result in results):
+        raise SearchFailed(f"Поиск '{game_name}' выполнен не полностью")
+    return {store: result.stores[store] for store, result in zip(stores, results)}
+
+
+async def backfill_links(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сохраняет счетчики обращений и в тихие часы ищет недостающие ссылки на магазины."""
+    await backfill.flush_request_counts()
+    if CATALOG_SNAPSHOT_DIR or not backfill.is_quiet_hour():
+        return
+    try:
+        updated = await backfill.backfill_missing_links(resolve_store_links)
+    except Exception as e:
+        logging.warning(f"Фоновый поиск ссылок прерван: {e}")
+        return
+    if updated:
+        logging.info(f"Фоновый поиск дополнил ссылки у {updated} игр")
+
+
+async def flush_callback_payloads(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сохраняет новые параметры кнопок, чтобы они пережили перезапуск."""
+    await callbacks.registry.flush()
+
+
+async def on_shutdown(application: Application) -> None:
+    """Освобождает ресурсы при остановке бота."""
+    await backfill.flush_request_counts()
+    await callbacks.registry.flush()
+    await metrics.close()
+    database.close()
+    websearch.close()
 
+
+def register_handlers(application: Application) -> None:
+    """Регистрирует обработчики команд, сообщений и кнопок."""
+    global ADD_GAME_CONVERSATION
     # Create the conversation handler for adding games
     add_game_conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Text("Добавить игру"), add_game)],
@@ -494,16 +812,139 @@ def main() -> None:
     )
 
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(show_genres_page, pattern="^genres_page_"))
-    application.add_handler(CallbackQueryHandler(show_games_by_genre, pattern="^genre_"))
-    application.add_handler(CallbackQueryHandler(show_game_links, pattern="^game_"))
+    application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("profile", profile_command))
+    for action, handler in (
+        ("genres", show_genres_page),
+        ("genre", show_games_by_genre),
+        ("game", show_game_links),
+        ("search", handle_search_callback),
+        ("store", handle_store_filter_callback),
+    ):
+        callbacks.route(action, metrics.instrument(handler))
+    application.add_handler(CallbackQueryHandler(callbacks.dispatch))
     application.add_handler(MessageHandler(filters.Text("Начать заново"), handle_start_button))
     application.add_handler(add_game_conv_handler)
+    ADD_GAME_CONVERSATION = add_game_conv_handler
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), search_game))
-    application.add_handler(CallbackQueryHandler(handle_search_callback, pattern="^search_"))
-    application.add_handler(CallbackQueryHandler(handle_store_filter_callback, pattern="^store_filter_"))
+    metrics.instrument_application(application)
+
+
+def update_lane(update: object) -> str:
+    """Относит обновление к полосе "search" (текстовый поиск, кнопки поиска) или "browse".
+
+    Сообщения, которые обработает диалог добавления игры (в том числе его
+    текстовые шаги), идут в "browse": их нельзя отклонить или отбросить.
+    """
+    if not isinstance(update, Update):
+        return "browse"
+    if ADD_GAME_CONVERSATION is not None and ADD_GAME_CONVERSATION.check_update(update):
+        return "browse"
+    if update.callback_query:
+        action = (update.callback_query.data or '').partition(':')[0]
+        return "search" if action in SEARCH_ACTIONS else "browse"
+    message = update.message
+    if message and message.text and not message.text.startswith('/') and message.text not in MENU_BUTTONS:
+        return "search"
+    return "browse"
+
+
+def register_gauges(application: Application) -> None:
+    """Публикует в метриках состояние очередей, кэшей и ограничителей."""
+    processor = application.update_processor
+    caches = {'search': SEARCH_CACHE, 'keyboard': KEYBOARD_CACHE}
+
+    def cache_stat(field: str):
+        return lambda: [({'cache': name}, cache.stats()[field]) for name, cache in caches.items()]
+
+    metrics.Gauge('bot_cache_hits_total', "Попадания в кэш", cache_stat('hits'), kind='counter')
+    metrics.Gauge('bot_cache_misses_total', "Промахи кэша", cache_stat('misses'), kind='counter')
+    metrics.Gauge('bot_cache_size', "Число записей в кэше", cache_stat('size'))
+    metrics.Gauge('bot_updates_in_progress', "Обновления в обработке",
+                  lambda: [({}, processor.current_concurrent_updates)])
+    if isinstance(processor, PerUserUpdateProcessor):
+        metrics.Gauge('bot_updates_dropped_total', "Сообщения, замененные более новыми",
+                      lambda: [({}, processor.dropped)], kind='counter')
+        metrics.Gauge('bot_lane_waiting', "Обновления, ждущие слота своей полосы",
+                      lambda: [({'lane': lane}, processor.lane_waiting[lane]) for lane in processor.lanes])
+        metrics.Gauge('bot_lane_running', "Обновления, выполняющиеся в полосе",
+                      lambda: [({'lane': lane}, processor.lane_running[lane]) for lane in processor.lanes])
+        metrics.Gauge('bot_updates_shed_total', "Обновления, отклоненные из-за переполнения полосы",
+                      lambda: [({'lane': lane}, processor.shed[lane]) for lane in processor.lanes], kind='counter')
+    metrics.Gauge('bot_websearch_queue_depth', "Запросы к поисковику, ждущие разрешения планировщика",
+                  lambda: [({'priority': 'interactive'}, websearch.scheduler.stats()['queue_interactive']),
+                           ({'priority': 'background'}, websearch.scheduler.stats()['queue_background'])])
+    metrics.Gauge('bot_websearch_rate', "Текущий темп запросов к поисковику, в секунду",
+                  lambda: [({}, websearch.scheduler.rate)])
+    metrics.Gauge('bot_websearch_429_total', "Ответы 429 от поисковика",
+                  lambda: [({}, websearch.scheduler.throttled)], kind='counter')
+    metrics.Gauge('bot_searches_active', "Веб-поиски пользователей в процессе",
+                  lambda: [({}, SEARCH_LIMITER.active())])
+    metrics.Gauge('bot_searches_rejected_total', "Поиски, отклоненные из-за уже идущего поиска пользователя",
+                  lambda: [({}, SEARCH_LIMITER.rejected)], kind='counter')
+    limiter = application.bot.rate_limiter
+    if isinstance(limiter, ratelimit.TelegramRateLimiter):
+        metrics.Gauge('bot_outbound_waiting', "Запросы к Bot API, ждущие своей очереди по лимитам Telegram",
+                      lambda: [({}, limiter.waiting)])
+        metrics.Gauge('bot_outbound_retry_after_total', "Повторы запросов к Bot API после ответа 429",
+                      lambda: [({}, limiter.retries)], kind='counter')
+
 
-    application.run_polling()
+def main() -> None:
+    """Запуск бота."""
+    logconfig.setup(LOG_LEVEL, LOG_FORMAT)
+    try:
+        run_bot()
+    finally:
+        logconfig.shutdown()
+
+
+def run_bot() -> None:
+    database.configure(DB_PATH, DB_POOL_SIZE)
+    database.migrate()
+    websearch.configure(SEARCH_WORKERS)
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(
+            CONCURRENT_UPDATES, DEBOUNCE_WINDOW,
+            lanes={"browse": CONCURRENT_UPDATES, "search": min(SEARCH_LANE_WORKERS, CONCURRENT_UPDATES)},
+            classify=update_lane,
+            shed_after={"search": SEARCH_LANE_QUEUE_LIMIT},
+            debounce_lanes={"search"}))
+        .rate_limiter(ratelimit.TelegramRateLimiter())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    register_handlers(application)
+    register_gauges(application)
+
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            check_catalog_version,
+            interval=SNAPSHOT_CHECK_INTERVAL if CATALOG_SNAPSHOT_DIR else CATALOG_CHECK_INTERVAL)
+        application.job_queue.run_repeating(backfill_links, interval=BACKFILL_INTERVAL)
+        application.job_queue.run_repeating(
+            flush_callback_payloads,
+            interval=SNAPSHOT_CALLBACK_FLUSH_INTERVAL if CATALOG_SNAPSHOT_DIR else CALLBACK_FLUSH_INTERVAL)
+    else:
+        logging.warning("JobQueue недоступна (python-telegram-bot[job-queue]), "
+                        "каталог не будет перечитываться, а ссылки - дозаполняться")
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("Для режима webhook нужно задать WEBHOOK_URL")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from fuzzywuzzy import fuzz
+
+NGRAM_SIZE = 3
+MAX_CANDIDATES = 200
+RESCORE_FACTOR = 4
+COMMON_GRAM_SHARE = 0.02
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text: str) -> str:
+    """Приводит название к виду для сравнения: нижний регистр, без знаков препинания."""
+    return _NON_WORD.sub(' ', text.casefold()).strip()
+
+
+def ngrams(text: str, size: int = NGRAM_SIZE) -> Set[str]:
+    padded = f' {text} '
+    if len(padded) < size:
+        return {padded}
+    return {padded[i:i + size] for i in range(len(padded) - size + 1)}
+
+
+class TitleMatcher:
+    """Нечеткий поиск названий игр по инвертированному индексу символьных n-грамм.
+
+    Индекс отбирает кандидатов с общими n-граммами, а fuzz.WRatio считается
+    только для небольшой их части, поэтому время поиска почти не зависит от
+    размера каталога.
+    """
+
+    def __init__(self, max_candidates: int = MAX_CANDIDATES) -> None:
+        self.max_candidates = max_candidates
+        self._names: List[str] = []
+        self._gram_counts: List[int] = []
+        self._positions: Dict[str, int] = {}
+        self._postings: Dict[str, List[int]] = {}
+        # Названия, добавленные во время rebuild; их нужно перенести в новый индекс.
+        self._pending: Optional[List[str]] = None
+
+    def build(self, names: Iterable[str]) -> None:
+        """Перестраивает индекс по полному списку названий."""
+        self._names, self._gram_counts, self._positions, self._postings = [], [], {}, {}
+        for name in names:
+            self.add(name)
+
+    async def rebuild(self, names: List[str]) -> None:
+        """То же, что build, но новый индекс строится в потоке, не останавливая цикл событий.
+
+        До подмены поиск идет по старому индексу; названия, добавленные за это
+        время через add, попадают и в новый.
+        """
+        fresh = TitleMatcher(self.max_candidates)
+        self._pending = []
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, fresh.build, names)
+            pending = self._pending
+        finally:
+            self._pending = None
+        for name in pending:
+            fresh.add(name)
+        self._names, self._gram_counts, self._positions, self._postings = (
+            fresh._names, fresh._gram_counts, fresh._positions, fresh._postings)
+
+    def add(self, name: str) -> None:
+        """Добавляет название в индекс; повторное добавление игнорируется."""
+        if self._pending is not None:
+            self._pending.append(name)
+        if name in self._positions:
+            return
+        position = len(self._names)
+        grams = ngrams(normalize(name))
+        self._names.append(name)
+        self._gram_counts.append(len(grams))
+        self._positions[name] = position
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(position)
+
+    def _posting(self, gram: str) -> Optional[Sequence[int]]:
+        return self._postings.get(gram)
+
+    def _name(self, position: int) -> str:
+        return self._names[position]
+
+    def _gram_count(self, position: int) -> int:
+        return self._gram_counts[position]
+
+    def _candidates(self, query_grams: Set[str]) -> Dict[int, int]:
+        """Возвращает кандидатов с числом общих с запросом n-грамм."""
+        postings = sorted(filter(None, map(self._posting, query_grams)), key=len)
+        if not postings:
+            return {}
+        # Частые n-граммы (" th", "the" ...) почти ничего не отсекают, но их списки
+        # самые длинные; кандидатов набираем по редким, а окончательный порядок
+        # все равно определяет fuzz.WRatio.
+        common_limit = max(self.max_candidates, int(len(self) * COMMON_GRAM_SHARE))
+        rare = [posting for posting in postings if len(posting) <= common_limit] or postings[:1]
+        counts: Dict[int, int] = {}
+        for posting in rare:
+            for position in posting:
+                counts[position] = counts.get(position, 0) + 1
+        if len(counts) <= self.max_candidates:
+            return counts
+        return {position: counts[position]
+                for position in heapq.nlargest(self.max_candidates, counts, key=counts.__getitem__)}
+
+    def match(self, query: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """Возвращает до limit пар (название, оценка 0-100) в порядке убывания оценки."""
+        normalized = normalize(query)
+        if not normalized:
+            return []
+        query_grams = ngrams(normalized)
+        candidates = self._candidates(query_grams)
+
+        def dice(position: int) -> float:
+            return 2 * candidates[position] / (len(query_grams) + self._gram_count(position))
+
+        shortlist = heapq.nlargest(limit * RESCORE_FACTOR, candidates, key=dice)
+        names = [self._name(position) for position in shortlist]
+        scored = [(name, fuzz.WRatio(query, name)) for name in names]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:limit]
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+matcher = TitleMatcher()
@@ -0,0 +1,247 @@
+import asyncio
+import bisect
+import functools
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from telegram.ext import Application, BaseHandler, ConversationHandler
+
+import profiler
+
+METRICS_HOST = '127.0.0.1'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Метрики обновляются только из потока цикла событий, поэтому обходятся без блокировок.
+_metrics: List['Metric'] = []
+_server: Optional[asyncio.AbstractServer] = None
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help = help_text
+        _metrics.append(self)
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        return ()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{_format_labels(labels)} {value:g}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def samples(self):
+        return ((self.name, labels, value) for labels, value in self._values.items())
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными границами корзин, как в Prometheus."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text)
+        self.buckets = buckets
+        # Метки -> [счетчики по корзинам (последняя - +Inf), сумма, количество].
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def series(self) -> Dict[Labels, Tuple[int, float]]:
+        """Возвращает для каждого набора меток (количество, сумма)."""
+        return {labels: (count, total) for labels, (_, total, count) in self._series.items()}
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Оценка квантиля сверху - граница корзины, в которую он попал."""
+        series = self._series.get(_labels(labels))
+        if series is None or not series[2]:
+            return None
+        rank = q * series[2]
+        for bound, cumulative in zip(self.buckets + (float('inf'),), itertools.accumulate(series[0])):
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        for labels, (counts, total, count) in self._series.items():
+            for bound, cumulative in zip(self.buckets + (float('inf'),), itertools.accumulate(counts)):
+                yield f"{self.name}_bucket", labels + (('le', '+Inf' if bound == float('inf') else f'{bound:g}'),), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Gauge(Metric):
+    """Значения, которые считываются из объектов бота в момент запроса метрик.
+
+    collect возвращает пары (метки, значение); kind='counter' - для монотонно
+    растущих счетчиков, которые уже ведутся в самих объектах.
+    """
+
+    def __init__(self, name: str, help_text: str, collect: Callable[[], Iterable[Tuple[dict, float]]],
+                 kind: str = 'gauge') -> None:
+        super().__init__(name, help_text)
+        self.kind = kind
+        self._collect = collect
+
+    def samples(self):
+        try:
+            return [(self.name, _labels(labels), value) for labels, value in self._collect()]
+        except Exception as e:
+            logging.warning(f"Не удалось собрать метрику {self.name}: {e}")
+            return []
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "Время обработки обновления обработчиком")
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Исключения в обработчиках")
+SQLITE_SECONDS = Histogram('bot_sqlite_query_seconds', "Время запроса к SQLite, включая ожидание потока пула")
+WEBSEARCH_SECONDS = Histogram('bot_websearch_seconds', "Время запроса страницы выдачи поисковика по исходу")
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def instrument(callback: Callable, name: Optional[str] = None) -> Callable:
+    """Оборачивает асинхронный обработчик замером времени и подсчетом исключений."""
+    label = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        profiler.tag_current_task(label)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=label)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler: BaseHandler) -> None:
+    if isinstance(handler, ConversationHandler):
+        for inner in itertools.chain(handler.entry_points, *handler.states.values(), handler.fallbacks):
+            _instrument_handler(inner)
+    elif not getattr(handler.callback, 'instrumented', False):
+        handler.callback = instrument(handler.callback)
+
+
+def instrument_application(application: Application) -> None:
+    """Оборачивает замером все зарегистрированные в приложении обработчики, включая шаги диалогов."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+def summary() -> str:
+    """Короткая сводка для команды /stats."""
+    lines = ["<b>Обработчики</b> (кол-во, среднее, p95):"]
+    for labels, (count, total) in sorted(HANDLER_SECONDS.series().items(), key=lambda item: -item[1][0]):
+        handler = dict(labels)['handler']
+        p95 = HANDLER_SECONDS.quantile(0.95, handler=handler)
+        errors = HANDLER_ERRORS.value(handler=handler)
+        lines.append(f"{handler}: {count}, {total / count * 1000:.1f} мс, ≤{p95 * 1000:g} мс"
+                     + (f", ошибок {errors:g}" if errors else ''))
+    for title, histogram in (("SQLite", SQLITE_SECONDS), ("Поисковик", WEBSEARCH_SECONDS)):
+        series = histogram.series()
+        count = sum(count for count, _ in series.values())
+        total = sum(total for _, total in series.values())
+        if count:
+            details = ", ".join(f"{dict(labels).popitem()[1]}: {c}" for labels, (c, _) in series.items() if labels)
+            lines.append(f"\n<b>{title}</b>: {count} запросов, в среднем {total / count * 1000:.1f} мс"
+                         + (f" ({details})" if details else ''))
+    return '\n'.join(lines)
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+            status, body = '200 OK', render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port: int, host: str = METRICS_HOST) -> None:
+    """Поднимает в цикле событий бота HTTP-эндпоинт /metrics для Prometheus."""
+    global _server
+    await close()
+    try:
+        _server = await asyncio.start_server(_handle_http, host, port)
+    except OSError as e:
+        logging.warning(f"Не удалось открыть порт метрик {host}:{port}: {e}")
+        return
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+
+async def close() -> None:
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
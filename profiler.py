@@ -0,0 +1,172 @@
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import re
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 10 * 60
+SLOW_CALLBACK_MS = 100
+REPORT_TOP = 40
+TASK_PREFIX = 'handler:'
+
+_TASK_NAME = re.compile(r"name='" + TASK_PREFIX + r"([^']+)'")
+USAGE = ("Использование: /profile [секунды | N u] [slow=мс], например /profile 60, "
+         "/profile 200u slow=50; /profile stop - завершить досрочно.")
+
+ReportSender = Callable[[str, bytes], Awaitable[None]]
+
+
+def tag_current_task(name: str) -> None:
+    """Помечает текущую задачу именем обработчика, чтобы предупреждения asyncio о блокировках указывали на него."""
+    task = asyncio.current_task()
+    if task is not None:
+        task.set_name(TASK_PREFIX + name)
+
+
+def parse_args(args: List[str]) -> Tuple[float, Optional[int], float]:
+    """Разбирает аргументы /profile: (секунды, число обновлений или None, порог в секундах)."""
+    seconds, updates, threshold = PROFILE_SECONDS, None, SLOW_CALLBACK_MS / 1000
+    for arg in args:
+        arg = arg.lower()
+        if arg.startswith('slow='):
+            threshold = float(arg[5:]) / 1000
+        elif arg.endswith('u'):
+            updates = int(arg[:-1])
+            seconds = MAX_PROFILE_SECONDS
+        else:
+            seconds = float(arg.rstrip('s'))
+        if seconds <= 0 or threshold <= 0 or (updates is not None and updates <= 0):
+            raise ValueError(USAGE)
+    return min(seconds, MAX_PROFILE_SECONDS), updates, threshold
+
+
+class _SlowCallbackCollector(logging.Handler):
+    """Перехватывает предупреждения asyncio "Executing ... took N seconds" из режима отладки цикла."""
+
+    def __init__(self) -> None:
+        super().__init__(logging.WARNING)
+        self.blocked: Dict[str, List[float]] = defaultdict(list)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not str(record.msg).startswith('Executing') or not record.args or len(record.args) < 2:
+            return
+        handle, seconds = record.args[0], record.args[1]
+        match = _TASK_NAME.search(str(handle))
+        self.blocked[match.group(1) if match else 'другое'].append(float(seconds))
+
+
+class ProfileSession:
+    """Один сеанс профилирования цикла событий: cProfile плюс учет его блокировок.
+
+    Профилируется только поток цикла событий; запросы к SQLite и поисковику
+    выполняются в своих пулах потоков и видны здесь как ожидание.
+    """
+
+    def __init__(self, seconds: float, updates: Optional[int], threshold: float, send: ReportSender) -> None:
+        self.seconds = seconds
+        self.updates = updates
+        self.threshold = threshold
+        self.processed = 0
+        self._send = send
+        self._loop = asyncio.get_running_loop()
+        self._profile = cProfile.Profile()
+        self._collector = _SlowCallbackCollector()
+        self._started = 0.0
+        self._elapsed = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._saved_debug = (False, 0.1)
+        self._report_task: Optional[asyncio.Task] = None
+        self.running = False
+
+    def start(self) -> None:
+        self._saved_debug = (self._loop.get_debug(), self._loop.slow_callback_duration)
+        self._loop.slow_callback_duration = self.threshold
+        self._loop.set_debug(True)
+        logging.getLogger('asyncio').addHandler(self._collector)
+        self._timer = self._loop.call_later(self.seconds, self.stop)
+        self._started = time.perf_counter()
+        self.running = True
+        self._profile.enable()
+
+    def update_done(self) -> None:
+        """Отмечает обновление, обработка которого началась во время сеанса."""
+        if not self.running:
+            return
+        self.processed += 1
+        if self.updates is not None and self.processed >= self.updates:
+            self.stop()
+
+    def stop(self) -> None:
+        global _session
+        if not self.running:
+            return
+        self._profile.disable()
+        self.running = False
+        self._elapsed = time.perf_counter() - self._started
+        if self._timer is not None:
+            self._timer.cancel()
+        logging.getLogger('asyncio').removeHandler(self._collector)
+        debug, duration = self._saved_debug
+        self._loop.set_debug(debug)
+        self._loop.slow_callback_duration = duration
+        if _session is self:
+            _session = None
+        self._report_task = self._loop.create_task(self._deliver())
+
+    async def _deliver(self) -> None:
+        try:
+            self._profile.create_stats()
+            # Тот же формат, что пишет Profile.dump_stats: файл открывается pstats и snakeviz.
+            raw = marshal.dumps(self._profile.stats)
+            await self._send(self.report(), raw)
+        except Exception as e:
+            logging.error(f"Не удалось отправить отчет профилирования: {e}")
+
+    def blocking_summary(self) -> List[str]:
+        rows = sorted(self._collector.blocked.items(), key=lambda item: -sum(item[1]))
+        return [f"{handler}: {len(times)} раз, всего {sum(times):.3f} с, максимум {max(times):.3f} с"
+                for handler, times in rows]
+
+    def report(self) -> str:
+        lines = [f"Профилирование: {self._elapsed:.1f} с, обновлений обработано: {self.processed}, "
+                 f"порог блокировки цикла: {self.threshold * 1000:g} мс", ""]
+        blocking = self.blocking_summary()
+        lines.append("Блокировки цикла событий по обработчикам:")
+        lines.extend(f"  {line}" for line in blocking or ["не было"])
+        stats = pstats.Stats(self._profile).strip_dirs()
+        for title, key in (("Горячие точки по собственному времени", 'tottime'),
+                           ("По накопленному времени", 'cumulative')):
+            stats.stream = io.StringIO()
+            stats.sort_stats(key).print_stats(REPORT_TOP)
+            lines += ["", f"{title}:", stats.stream.getvalue()]
+        return "\n".join(lines)
+
+
+_session: Optional[ProfileSession] = None
+
+
+def active() -> Optional[ProfileSession]:
+    return _session
+
+
+def start(seconds: float, updates: Optional[int], threshold: float, send: ReportSender) -> ProfileSession:
+    """Запускает сеанс; send получит текстовый отчет и сырые данные cProfile (формат pstats)."""
+    global _session
+    if _session is not None:
+        raise RuntimeError("Профилирование уже запущено")
+    _session = ProfileSession(seconds, updates, threshold, send)
+    _session.start()
+    return _session
+
+
+def stop() -> bool:
+    if _session is None:
+        return False
+    _session.stop()
+    return True
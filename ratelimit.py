@@ -0,0 +1,138 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Ограничения Bot API: около 30 сообщений в секунду на бота, не чаще раза в
+# секунду в один личный чат (короткие всплески допустимы) и 20 в минуту в группу.
+OVERALL_RATE = 30.0
+OVERALL_BURST = 30
+PRIVATE_CHAT_RATE = 1.0
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 5
+MAX_RETRIES = 3
+MAX_CHAT_BUCKETS = 10000
+# Методы без отправки сообщений, которые не нужно задерживать.
+UNLIMITED_ENDPOINTS = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'close', 'logOut'}
+
+JSONResult = Union[bool, Dict[str, Any], list]
+
+
+class TokenBucket:
+    """Токен-бакет с очередью: ожидающие получают разрешения строго по порядку прихода."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def idle(self) -> bool:
+        """Бакет полон и никто его не ждет - его можно забыть без потери ограничения."""
+        self._refill()
+        return self._tokens >= self.burst and not self._lock.locked()
+
+
+class TelegramRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """Очередь исходящих запросов к Bot API с общим лимитом и лимитом на чат.
+
+    Запрос сначала ждет разрешения своего чата, затем общего бакета, так что
+    частые правки в одном чате не задерживают остальных. На ответ 429
+    (RetryAfter) отправка приостанавливается для всех запросов на указанное
+    Telegram время, и запрос повторяется до max_retries раз. rate_limit_args
+    вызова может переопределить {'max_retries': N}.
+    """
+
+    def __init__(self, overall_rate: float = OVERALL_RATE, private_chat_rate: float = PRIVATE_CHAT_RATE,
+                 group_chat_rate: float = GROUP_CHAT_RATE, max_retries: int = MAX_RETRIES) -> None:
+        self.overall_rate = overall_rate
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.max_retries = max_retries
+        self.waiting = 0
+        self.retries = 0
+        self._overall: Optional[TokenBucket] = None
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._paused_until = 0.0
+
+    async def initialize(self) -> None:
+        self._overall = TokenBucket(self.overall_rate, OVERALL_BURST)
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle()}
+            # Отрицательные id и @username - группы и каналы.
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = self._chats[chat_id] = (TokenBucket(self.group_chat_rate, GROUP_CHAT_BURST) if is_group
+                                             else TokenBucket(self.private_chat_rate, PRIVATE_CHAT_BURST))
+        return bucket
+
+    async def _wait_turn(self, chat_id: Optional[Union[int, str]]) -> None:
+        self.waiting += 1
+        try:
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            if self._overall is None:
+                await self.initialize()
+            await self._overall.acquire()
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+        finally:
+            self.waiting -= 1
+
+    def _pause(self, error: RetryAfter) -> float:
+        delay = error.retry_after
+        delay = delay.total_seconds() if isinstance(delay, datetime.timedelta) else float(delay)
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, JSONResult]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> JSONResult:
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        max_retries = (rate_limit_args or {}).get('max_retries', self.max_retries)
+        chat_id = data.get('chat_id')
+        attempt = 0
+        while True:
+            await self._wait_turn(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                delay = self._pause(e)
+                logging.warning(f"Telegram ограничил частоту запросов ({endpoint}), пауза {delay:g} с")
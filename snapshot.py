@@ -0,0 +1,408 @@
+import argparse
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import catalog
+import matcher
+from database import Game
+from matcher import TitleMatcher, ngrams, normalize
+
+MAGIC = b'GCSN'
+FORMAT_VERSION = 1
+CURRENT_FILE = 'CURRENT'
+KEEP_SNAPSHOTS = 2
+WATCH_INTERVAL = 30
+
+# Заголовок: сигнатура, формат, версия каталога, число игр, жанров и n-грамм,
+# затем смещения секций: строки, игры, жанры, игры жанров, n-граммы, списки
+# позиций n-грамм, число n-грамм каждого названия.
+HEADER = struct.Struct('<4sIQIII7Q')
+# id, название, номер жанра, ссылки steam/gog/epic; строка - (смещение, длина) в пуле.
+GAME = struct.Struct('<IIIIIIIIII')
+# Имя (смещение, длина в пуле) и срез (начало, длина) в секции позиций: игры жанра или n-граммы.
+ENTRY = struct.Struct('<IIII')
+U32 = struct.Struct('<I')
+U16 = struct.Struct('<H')
+NULL = 0xFFFFFFFF
+
+_U32_CODE = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def _align(buffer: bytearray) -> None:
+    buffer.extend(b'\0' * (-len(buffer) % 8))
+
+
+class _StringPool:
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self._offsets: Dict[str, int] = {}
+
+    def put(self, text: Optional[str]) -> Tuple[int, int]:
+        if text is None:
+            return NULL, 0
+        encoded = text.encode('utf-8')
+        offset = self._offsets.get(text)
+        if offset is None:
+            offset = self._offsets[text] = len(self.data)
+            self.data.extend(encoded)
+        return offset, len(encoded)
+
+
+def compile_snapshot(games: Sequence[Game], version: int, path: str) -> None:
+    """Записывает неизменяемый снимок каталога: игры, жанры и индекс n-грамм для нечеткого поиска."""
+    games = sorted(games, key=lambda game: game.id)
+    pool = _StringPool()
+
+    genre_members: Dict[str, List[int]] = {}
+    for position, game in enumerate(games):
+        genre_members.setdefault(game.genre, []).append(position)
+    genres = sorted(genre_members)
+    genre_index = {genre: index for index, genre in enumerate(genres)}
+
+    game_records = bytearray()
+    postings: Dict[str, List[int]] = {}
+    gram_counts = bytearray()
+    for position, game in enumerate(games):
+        game_records += GAME.pack(game.id, *pool.put(game.name), genre_index[game.genre],
+                                  *pool.put(game.steam_link), *pool.put(game.gog_link), *pool.put(game.epic_link))
+        grams = ngrams(normalize(game.name))
+        gram_counts += U16.pack(min(len(grams), 0xFFFF))
+        for gram in grams:
+            postings.setdefault(gram, []).append(position)
+
+    genre_records, members = bytearray(), array(_U32_CODE)
+    for genre in genres:
+        positions = genre_members[genre]
+        positions.sort(key=lambda position: (games[position].name.casefold(), games[position].id))
+        genre_records += ENTRY.pack(*pool.put(genre), len(members), len(positions))
+        members.extend(positions)
+
+    # N-граммы сортируются по байтам UTF-8, чтобы читатель искал их двоичным поиском без декодирования.
+    gram_records, posting_data = bytearray(), array(_U32_CODE)
+    for gram in sorted(postings, key=lambda gram: gram.encode('utf-8')):
+        gram_records += ENTRY.pack(*pool.put(gram), len(posting_data), len(postings[gram]))
+        posting_data.extend(postings[gram])
+
+    if sys.byteorder == 'big':
+        members.byteswap()
+        posting_data.byteswap()
+
+    sections = [pool.data, game_records, genre_records, members.tobytes(), gram_records,
+                posting_data.tobytes(), gram_counts]
+    body, offsets = bytearray(), []
+    for section in sections:
+        offsets.append(HEADER.size + len(body))
+        body += section
+        _align(body)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, version, len(games), len(genres), len(postings), *offsets)
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(header)
+        file.write(body)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+class _Postings:
+    """Список позиций n-граммы; читается из снимка только при переборе."""
+
+    __slots__ = ('_snapshot', '_first', '_count')
+
+    def __init__(self, snapshot: 'Snapshot', first: int, count: int) -> None:
+        self._snapshot = snapshot
+        self._first = first
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._snapshot._u32_slice(self._snapshot._postings_offset, self._first, self._count))
+
+
+class Snapshot:
+    """Открытый только на чтение снимок каталога, отображенный в память.
+
+    Данные не копируются в процесс: страницы файла лежат в общем кэше ОС, и
+    сколько бы процессов ни открыло один снимок, в памяти он будет один раз.
+    Из файла при обращении декодируются только нужные записи.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as file:
+            self._mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, fmt, self.version, self.game_count, genre_count, self.gram_count,
+         self._strings_offset, self._games_offset, genres_offset, self._members_offset,
+         self._grams_offset, self._postings_offset, self._gram_counts_offset) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            self._mm.close()
+            raise ValueError(f"{path}: не снимок каталога или неподдерживаемый формат")
+
+        # Жанров немного, их список держим в памяти, чтобы листать без двоичного поиска.
+        self.genres: List[str] = []
+        self._genre_slices: Dict[str, Tuple[int, int]] = {}
+        for index in range(genre_count):
+            name_offset, name_length, first, count = ENTRY.unpack_from(self._mm, genres_offset + index * ENTRY.size)
+            genre = self._string(name_offset, name_length)
+            self.genres.append(genre)
+            self._genre_slices[genre] = (first, count)
+
+    def close(self) -> None:
+        self._mm.close()
+
+    def _string(self, offset: int, length: int) -> Optional[str]:
+        if offset == NULL:
+            return None
+        start = self._strings_offset + offset
+        return self._mm[start:start + length].decode('utf-8')
+
+    def _u32_slice(self, section: int, first: int, count: int) -> array:
+        values = array(_U32_CODE)
+        values.frombytes(self._mm[section + first * 4:section + (first + count) * 4])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def game_at(self, position: int) -> Game:
+        fields = GAME.unpack_from(self._mm, self._games_offset + position * GAME.size)
+        return Game(fields[0], self._string(fields[1], fields[2]), self.genres[fields[3]],
+                    self._string(fields[4], fields[5]), self._string(fields[6], fields[7]),
+                    self._string(fields[8], fields[9]))
+
+    def name_at(self, position: int) -> str:
+        _, offset, length = struct.unpack_from('<III', self._mm, self._games_offset + position * GAME.size)
+        return self._string(offset, length)
+
+    def find(self, game_id: int) -> Optional[int]:
+        """Возвращает позицию игры по id двоичным поиском по записям, отсортированным по id."""
+        low, high = 0, self.game_count
+        while low < high:
+            middle = (low + high) // 2
+            current, = U32.unpack_from(self._mm, self._games_offset + middle * GAME.size)
+            if current < game_id:
+                low = middle + 1
+            elif current > game_id:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def genre_members(self, genre: str, start: int, count: int) -> array:
+        first, total = self._genre_slices.get(genre, (0, 0))
+        start = min(start, total)
+        return self._u32_slice(self._members_offset, first + start, min(count, total - start))
+
+    def posting(self, gram: str) -> Optional[_Postings]:
+        key = gram.encode('utf-8')
+        low, high = 0, self.gram_count
+        while low < high:
+            middle = (low + high) // 2
+            offset, length, first, count = ENTRY.unpack_from(self._mm, self._grams_offset + middle * ENTRY.size)
+            start = self._strings_offset + offset
+            current = self._mm[start:start + length]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return _Postings(self, first, count)
+        return None
+
+    def gram_count_at(self, position: int) -> int:
+        return U16.unpack_from(self._mm, self._gram_counts_offset + position * U16.size)[0]
+
+
+def current_snapshot(directory: str) -> Optional[str]:
+    """Возвращает имя файла текущего снимка из CURRENT или None, если снимков еще нет."""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE), encoding='utf-8') as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish(directory: str, games: Sequence[Game], version: int) -> str:
+    """Собирает снимок в directory и атомарно делает его текущим.
+
+    Старые файлы удаляются, кроме KEEP_SNAPSHOTS последних: процессы, которые
+    их еще не сменили, продолжают читать уже отображенные страницы.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"catalog-{version}-{int(time.time())}.snap"
+    compile_snapshot(games, version, os.path.join(directory, name))
+    pointer = os.path.join(directory, CURRENT_FILE)
+    with open(pointer + '.tmp', 'w', encoding='utf-8') as file:
+        file.write(name)
+    os.replace(pointer + '.tmp', pointer)
+
+    snapshots = sorted((entry for entry in os.listdir(directory) if entry.endswith('.snap')),
+                       key=lambda entry: os.path.getmtime(os.path.join(directory, entry)))
+    for stale in snapshots[:-KEEP_SNAPSHOTS]:
+        if stale != name:
+            os.remove(os.path.join(directory, stale))
+    return name
+
+
+class SnapshotCatalog:
+    """Каталог для рабочих процессов: тот же интерфейс чтения, что у Catalog, но данные - в снимке.
+
+    Каталог только читается; добавленные через бота игры попадут в него со
+    следующим снимком. reload_if_changed переключается на новый снимок, как
+    только меняется файл CURRENT.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.loaded = False
+        self._current: Optional[str] = None
+        self._snapshot: Optional[Snapshot] = None
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version if self._snapshot else 0
+
+    async def load(self) -> None:
+        if not await self.reload_if_changed() and self._snapshot is None:
+            raise FileNotFoundError(f"В {self.directory} нет снимка каталога, соберите его: python snapshot.py build")
+
+    async def reload_if_changed(self) -> bool:
+        name = current_snapshot(self.directory)
+        if name is None or name == self._current:
+            return False
+        previous, self._snapshot = self._snapshot, Snapshot(os.path.join(self.directory, name))
+        self._current = name
+        self.loaded = True
+        if previous is not None:
+            previous.close()
+        logging.info(f"Открыт снимок каталога {name}: {self._snapshot.game_count} игр, "
+                     f"{len(self._snapshot.genres)} жанров, версия {self._snapshot.version}")
+        return True
+
+    def add(self, game: Game) -> None:
+        pass
+
+    def apply(self, game: Game, version: int) -> None:
+        logging.debug(f"Игра '{game.name}' появится в каталоге со следующим снимком")
+
+    def get(self, game_id: int) -> Optional[Game]:
+        position = self._snapshot.find(game_id)
+        return None if position is None else self._snapshot.game_at(position)
+
+    def genres(self) -> List[str]:
+        return self._snapshot.genres
+
+    def genres_page(self, page: int, per_page: int) -> Tuple[List[str], bool]:
+        start = page * per_page
+        window = self._snapshot.genres[start:start + per_page + 1]
+        return window[:per_page], len(window) > per_page
+
+    def games_page(self, genre: str, page: int, per_page: int) -> Tuple[List[Game], bool]:
+        window = self._snapshot.genre_members(genre, page * per_page, per_page + 1)
+        return [self._snapshot.game_at(position) for position in window[:per_page]], len(window) > per_page
+
+    def names(self) -> Iterator[str]:
+        return (self._snapshot.name_at(position) for position in range(self._snapshot.game_count))
+
+    def __len__(self) -> int:
+        return self._snapshot.game_count if self._snapshot else 0
+
+
+class SnapshotMatcher(TitleMatcher):
+    """Нечеткий поиск по индексу n-грамм из текущего снимка каталога source."""
+
+    def __init__(self, source: SnapshotCatalog, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.source = source
+
+    def build(self, names) -> None:
+        pass
+
+    def add(self, name: str) -> None:
+        pass
+
+    def _posting(self, gram: str) -> Optional[Sequence[int]]:
+        return self.source._snapshot.posting(gram)
+
+    def _name(self, position: int) -> str:
+        return self.source._snapshot.name_at(position)
+
+    def _gram_count(self, position: int) -> int:
+        return self.source._snapshot.gram_count_at(position)
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+
+def open_catalog(directory: Optional[str]) -> Tuple[object, TitleMatcher]:
+    """Каталог и поиск по названиям для процесса бота.
+
+    С directory - общий снимок из этого каталога, иначе - собственные копии
+    процесса (catalog.catalog и matcher.matcher).
+    """
+    if directory:
+        source = SnapshotCatalog(directory)
+        return source, SnapshotMatcher(source)
+    return catalog.catalog, matcher.matcher
+
+
+def _catalog_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'catalog_version'").fetchone()
+    return row[0] if row else 0
+
+
+def _read_games(conn: sqlite3.Connection) -> List[Game]:
+    return [Game.from_row(row) for row in conn.execute("SELECT id, name, genre, steam_link, gog_link, epic_link FROM games")]
+
+
+def _published_version(directory: str) -> Optional[int]:
+    name = current_snapshot(directory)
+    if name is None:
+        return None
+    try:
+        return int(name.split('-')[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Сборка снимка каталога для рабочих процессов бота.")
+    parser.add_argument('command', choices=('build',))
+    parser.add_argument('--db', default='games.db')
+    parser.add_argument('--dir', default='snapshots', help="каталог со снимками и файлом CURRENT")
+    parser.add_argument('--force', action='store_true', help="собрать, даже если версия каталога не менялась")
+    parser.add_argument('--watch', type=float, nargs='?', const=WATCH_INTERVAL, metavar='SECONDS',
+                        help="не завершаться, а пересобирать снимок при изменении версии каталога")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    force = args.force
+    while True:
+        conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+        try:
+            # Версия и игры читаются в одной транзакции, чтобы снимок не разошелся со своей версией.
+            conn.execute("BEGIN")
+            version = _catalog_version(conn)
+            if force or _published_version(args.dir) != version:
+                started = time.perf_counter()
+                games = _read_games(conn)
+                name = publish(args.dir, games, version)
+                logging.info(f"Снимок {name}: {len(games)} игр за {time.perf_counter() - started:.1f} с")
+        finally:
+            conn.close()
+        force = False
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+if __name__ == '__main__':
+    main()
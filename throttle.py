@@ -0,0 +1,27 @@
+from collections import Counter
+
+MAX_SEARCHES_PER_USER = 1
+
+
+class UserSearchLimiter:
+    """Ограничивает число одновременных веб-поисков одного пользователя."""
+
+    def __init__(self, max_per_user: int = MAX_SEARCHES_PER_USER) -> None:
+        self.max_per_user = max_per_user
+        self.rejected = 0
+        self._active: Counter = Counter()
+
+    def try_acquire(self, user_id: int) -> bool:
+        if self._active[user_id] >= self.max_per_user:
+            self.rejected += 1
+            return False
+        self._active[user_id] += 1
+        return True
+
+    def release(self, user_id: int) -> None:
+        self._active[user_id] -= 1
+        if self._active[user_id] <= 0:
+            del self._active[user_id]
+
+    def active(self) -> int:
+        return sum(self._active.values())
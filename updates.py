@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+import logconfig
+import profiler
+
+
+DEBOUNCE_WINDOW = 1.0
+DEFAULT_LANE = 'default'
+BUSY_TEXT = "Бот сейчас перегружен поисковыми запросами, попробуйте через минуту."
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления параллельно, но сообщения одного пользователя - строго по очереди.
+
+    Диалог добавления игры (ConversationHandler) состоит из текстовых
+    сообщений, и его состояние ломается, если два сообщения пользователя
+    обрабатываются одновременно. Нажатия кнопок от этого не зависят и
+    выполняются без ожидания.
+
+    Текстовое сообщение, которое еще ждет своей очереди, отбрасывается, если
+    следом за ним (в пределах debounce_window секунд) пришло новое: из серии
+    быстро набранных сообщений обрабатывается только последнее.
+
+    classify относит обновление к полосе (например, "browse" или "search"), а
+    lanes задает, сколько обновлений каждой полосы может выполняться
+    одновременно в рамках общего max_concurrent_updates. Так долгие поиски не
+    занимают все слоты, и листание каталога не ждет их. Если в очереди полосы
+    ждут shed_after[полоса] обновлений, новые сразу получают ответ BUSY_TEXT.
+    debounce_lanes ограничивает отбрасывание сообщений этими полосами (по
+    умолчанию - все).
+    """
+
+    def __init__(self, max_concurrent_updates: int, debounce_window: float = DEBOUNCE_WINDOW,
+                 lanes: Optional[Dict[str, int]] = None, classify: Optional[Callable[[object], str]] = None,
+                 shed_after: Optional[Dict[str, int]] = None,
+                 debounce_lanes: Optional[Iterable[str]] = None) -> None:
+        super().__init__(max_concurrent_updates)
+        self.debounce_window = debounce_window
+        self.dropped = 0
+        self.classify = classify
+        self.lanes = lanes or {DEFAULT_LANE: max_concurrent_updates}
+        self.shed_after = shed_after or {}
+        self.debounce_lanes = None if debounce_lanes is None else frozenset(debounce_lanes)
+        self.shed: Counter = Counter()
+        self.lane_waiting: Counter = Counter()
+        self.lane_running: Counter = Counter()
+        self._lane_slots = {lane: asyncio.BoundedSemaphore(limit) for lane, limit in self.lanes.items()}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+        self._latest_text: Dict[int, Tuple[int, float]] = {}
+
+    @staticmethod
+    def ordering_key(update: object) -> Optional[int]:
+        """Возвращает id пользователя, если обновление нужно упорядочить, иначе None."""
+        if isinstance(update, Update) and update.message and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    def lane_of(self, update: object) -> str:
+        lane = self.classify(update) if self.classify else DEFAULT_LANE
+        return lane if lane in self._lane_slots else next(iter(self._lane_slots))
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        lane = self.lane_of(update)
+        limit = self.shed_after.get(lane)
+        if limit is not None and self.lane_waiting[lane] >= limit:
+            coroutine.close()
+            self.shed[lane] += 1
+            await self._reply_busy(update)
+            return
+
+        user_id = self.ordering_key(update)
+        if user_id is None:
+            await self._process_in_lane(lane, update, coroutine)
+            return
+
+        arrived = time.monotonic()
+        is_text = (bool(update.message.text) and not update.message.text.startswith('/')
+                   and (self.debounce_lanes is None or lane in self.debounce_lanes))
+        if is_text:
+            self._latest_text[user_id] = (update.update_id, arrived)
+
+        # Блокировку пользователя берем до общего семафора, чтобы очередь
+        # сообщений одного пользователя не занимала слоты остальных.
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._waiting[user_id] = self._waiting.get(user_id, 0) + 1
+        try:
+            async with lock:
+                if is_text and self._superseded(user_id, update.update_id, arrived):
+                    coroutine.close()
+                    self.dropped += 1
+                    logging.debug(f"Сообщение {update.update_id} пользователя {user_id} заменено более новым")
+                    return
+                await self._process_in_lane(lane, update, coroutine)
+        finally:
+            self._waiting[user_id] -= 1
+            if not self._waiting[user_id]:
+                del self._waiting[user_id]
+                del self._locks[user_id]
+                self._latest_text.pop(user_id, None)
+
+    async def _process_in_lane(self, lane: str, update: object, coroutine: Awaitable[Any]) -> None:
+        slots = self._lane_slots[lane]
+        self.lane_waiting[lane] += 1
+        try:
+            await slots.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        finally:
+            self.lane_waiting[lane] -= 1
+        self.lane_running[lane] += 1
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self.lane_running[lane] -= 1
+            slots.release()
+
+    @staticmethod
+    async def _reply_busy(update: object) -> None:
+        if not isinstance(update, Update):
+            return
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(BUSY_TEXT, show_alert=True)
+            elif update.effective_message:
+                await update.effective_message.reply_text(BUSY_TEXT)
+        except TelegramError as e:
+            logging.warning(f"Не удалось ответить на отклоненное обновление {update.update_id}: {e}")
+
+    def _superseded(self, user_id: int, update_id: int, arrived: float) -> bool:
+        latest_id, latest_arrived = self._latest_text[user_id]
+        return latest_id != update_id and latest_arrived - arrived <= self.debounce_window
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Каждое обновление обрабатывается в своей задаче, поэтому id попадут
+        # только в записи этого обновления и запущенных из него задач.
+        if isinstance(update, Update):
+            logconfig.bind(update.update_id, update.effective_user.id if update.effective_user else None)
+        # Сеанс профилирования считает только обновления, начатые после его запуска,
+        # поэтому сама команда /profile и уже шедшие обновления в счет не входят.
+        session = profiler.active()
+        try:
+            await coroutine
+        finally:
+            if session is not None:
+                session.update_done()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,274 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.parse import quote_plus, urlparse
+from urllib.request import Request, urlopen
+
+import googlesearch
+from bs4 import BeautifulSoup
+
+import metrics
+
+PAGE_SIZE = 5
+SEARCH_WORKERS = 4
+SEARCH_TIMEOUT = 20.0
+# Таймаут сокета запроса к поисковику: зависший запрос освобождает поток пула,
+# а не держит его бесконечно после того, как SEARCH_TIMEOUT уже истек.
+HTTP_TIMEOUT = 10.0
+# Темп запросов задает планировщик, поэтому собственная пауза googlesearch не нужна.
+SEARCH_PAUSE = 0.0
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+INITIAL_RATE = 0.5
+MIN_RATE = 0.05
+MAX_RATE = 2.0
+RATE_INCREASE = 0.02
+RATE_DECREASE = 1.5
+BURST = 3
+
+
+
+class SearchPageFailed(Exception):
+    """Страница выдачи не получена: таймаут или ошибка сети (кроме 429)."""
+
+
+class SearchScheduler:
+    """Общий для всех запросов к поисковику планировщик.
+
+    Разрешения выдаются по токен-бакету, темп которого подстраивается по AIMD:
+    после каждого успешного запроса он растет на RATE_INCREASE, после ответа
+    429 делится на RATE_DECREASE. Ожидающие запросы обслуживаются по
+    приоритету: сначала INTERACTIVE, затем BACKGROUND.
+    """
+
+    def __init__(self, rate: float = INITIAL_RATE, burst: int = BURST) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.granted = 0
+        self.throttled = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._queue: list = []
+        self._order = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = INTERACTIVE) -> None:
+        """Ждет разрешения на один запрос к поисковику."""
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._order), waiter))
+        self._wakeup.set()
+        await waiter
+
+    async def _dispatch(self) -> None:
+        while True:
+            while self._queue and self._queue[0][2].done():
+                heapq.heappop(self._queue)
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                self._tokens -= 1
+                self.granted += 1
+                waiter.set_result(None)
+
+    def on_success(self) -> None:
+        self.rate = min(MAX_RATE, self.rate + RATE_INCREASE)
+
+    def on_throttled(self) -> None:
+        self.throttled += 1
+        self.rate = max(MIN_RATE, self.rate / RATE_DECREASE)
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+    def stats(self) -> dict:
+        waiting = [entry for entry in self._queue if not entry[2].done()]
+        return {
+            'rate': self.rate,
+            'queue_depth': len(waiting),
+            'queue_interactive': sum(1 for entry in waiting if entry[0] == INTERACTIVE),
+            'queue_background': sum(1 for entry in waiting if entry[0] == BACKGROUND),
+            'granted': self.granted,
+            'throttled': self.throttled,
+        }
+
+
+def google_page(query: str, num: int = PAGE_SIZE, start: int = 0, stop: Optional[int] = None,
+                pause: float = 0.0) -> List[str]:
+    """Одна страница выдачи Google ровно одним HTTP-запросом с таймаутом HTTP_TIMEOUT.
+
+    Сигнатура и разбор ответа - как у googlesearch.search, но без запроса
+    главной страницы и без догрузки следующей страницы, если эта оказалась
+    короче num: так каждый вызов соответствует одному разрешению планировщика.
+    """
+    params = {'tld': 'com', 'lang': 'en', 'query': quote_plus(query), 'num': num, 'start': start,
+              'tbs': '0', 'safe': 'off', 'country': ''}
+    url = (googlesearch.url_next_page_num if start else googlesearch.url_search_num) % params
+    request = Request(url, headers={'User-Agent': googlesearch.USER_AGENT})
+    googlesearch.cookie_jar.add_cookie_header(request)
+    with urlopen(request, timeout=HTTP_TIMEOUT) as response:
+        googlesearch.cookie_jar.extract_cookies(response, request)
+        page = response.read()
+
+    soup = BeautifulSoup(page, 'html.parser')
+    container = soup.find(id='search') or soup
+    links: List[str] = []
+    for anchor in container.find_all('a', href=True):
+        link = googlesearch.filter_result(anchor['href'])
+        if link and link not in links:
+            links.append(link)
+            if len(links) >= (stop or num):
+                break
+    return links
+
+
+scheduler = SearchScheduler()
+_workers = SEARCH_WORKERS
+_backend = google_page
+
+# Магазин -> домен для site:-запроса и фрагмент пути страницы игры в этом магазине.
+STORE_SITES = {
+    'steam': 'store.steampowered.com',
+    'gog': 'gog.com',
+    'epic': 'store.epicgames.com',
+}
+CANONICAL_PATHS = {
+    'steam': '/app/',
+    'gog': '/game/',
+    'epic': '/p/',
+}
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def configure(workers: int = SEARCH_WORKERS) -> None:
+    """Задает число потоков, в которых выполняются запросы к поисковику."""
+    global _workers
+    close()
+    _workers = workers
+
+
+def close() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def set_backend(backend=None) -> None:
+    """Подменяет функцию поиска (с сигнатурой googlesearch.search), например на локальную заглушку.
+
+    Без аргумента возвращает google_page.
+    """
+    global _backend
+    _backend = backend or google_page
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='search')
+    return _executor
+
+
+def _search_blocking(query: str, page_num: int, cancelled: threading.Event) -> List[str]:
+    # stop - число выдаваемых результатов, считая от start, а не номер последнего.
+    results = []
+    for result in _backend(query, num=PAGE_SIZE, start=page_num * PAGE_SIZE, stop=PAGE_SIZE, pause=SEARCH_PAUSE):
+        if cancelled.is_set():
+            break
+        results.append(result)
+        if len(results) >= PAGE_SIZE:
+            break
+    return results
+
+
+async def search_page(query: str, page_num: int, priority: int = INTERACTIVE,
+                      timeout: float = SEARCH_TIMEOUT) -> List[str]:
+    """Возвращает одну страницу поисковой выдачи, не блокируя цикл событий.
+
+    Запрос ждет разрешения планировщика и выполняется в пуле потоков с
+    ограничением по времени. Ошибка 429 замедляет планировщик и
+    пробрасывается вызывающему; прочие ошибки и таймаут превращаются в
+    SearchPageFailed, чтобы их нельзя было спутать с пустой выдачей.
+    """
+    await scheduler.acquire(priority)
+    logging.debug(f"Поисковый запрос: {query}, страница: {page_num}")
+    cancelled = threading.Event()
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_get_executor(), _search_blocking, query, page_num, cancelled)
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        results_from_page = await asyncio.wait_for(future, timeout)
+    except asyncio.CancelledError:
+        outcome = 'cancelled'
+        raise
+    except asyncio.TimeoutError:
+        outcome = 'timeout'
+        logging.warning(f"Поиск '{query}' (страница {page_num}) не уложился в {timeout} с")
+        raise SearchPageFailed(f"таймаут {timeout} с") from None
+    except HTTPError as e:
+        if e.code == 429:
+            outcome = 'throttled'
+            scheduler.on_throttled()
+            raise
+        outcome = 'error'
+        logging.error(f"Ошибка при пагинации: {e}")
+        raise SearchPageFailed(str(e)) from e
+    except Exception as e:
+        outcome = 'error'
+        logging.error(f"Ошибка при пагинации: {e}")
+        raise SearchPageFailed(str(e)) from e
+    finally:
+        cancelled.set()
+        metrics.WEBSEARCH_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+    scheduler.on_success()
+
+    # Построчный вывод выдачи нужен только при отладке и не должен ничего стоить на INFO.
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Результаты поиска '{query}' (страница {page_num}): {len(results_from_page)}"
+                      + "".join(f"\n   {i}: {result}" for i, result in enumerate(results_from_page)))
+    return results_from_page
+
+
+def plan_queries(game_name: str, store_filter: Optional[str] = None) -> List[Tuple[str, str]]:
+    """Возвращает пары (магазин, запрос) с site:-ограничением для каждого нужного магазина."""
+    name = " ".join(game_name.split())
+    stores = [store_filter] if store_filter else list(STORE_SITES)
+    return [(store, f"{name} site:{STORE_SITES[store]}") for store in stores]
+
+
+def classify_link(url: str) -> Optional[str]:
+    """Определяет магазин по домену ссылки, а не по вхождению подстроки."""
+    host = (urlparse(url).hostname or '').lower()
+    for store, domain in STORE_SITES.items():
+        if host == domain or host.endswith('.' + domain):
+            return store
+    return None
+
+
+def is_canonical_link(store: str, url: str) -> bool:
+    """Проверяет, что ссылка ведет на страницу игры в магазине, а не на новость или форум."""
+    return CANONICAL_PATHS[store] in urlparse(url).path